@@ -1,4 +1,11 @@
 """Rules that analyse the data."""
+TABLE_SUFFIX = config["table-format"]
+
+
+def unpinned(path):
+    """Refers to an output without requiring the rule that declares it, so that a batch rule producing the same
+    file can be chosen by ruleorder. Inputs of the form `rules.<rule>.output` always use <rule>."""
+    return str(path)
 
 
 rule lcoe:
@@ -16,17 +23,47 @@ rule lcoe:
         lcoe = "build/data/lcoe-eur-per-mwh.tif",
         annual_energy = "build/data/annual-energy-mwh.tif"
     conda: "../envs/default.yaml"
-    shell: "python {input} {params} {output}"
+    shell: "python {input} {params} {output} " + encoding_arguments("lcoe")
+
+
+rule lcoe_sweep:
+    message: "Calculate LCOE from capacity factors for all scenarios of the sweep."
+    input:
+        script = "scripts/lcoe.py",
+        capacity_factors = rules.capacity_factors.output[0],
+    params:
+        investment_cost = config["parameters"]["sweep"]["investment-cost"],
+        annual_maintenance_cost = config["parameters"]["sweep"]["annual-maintenance-cost"],
+        discount_rate = config["parameters"]["sweep"]["discount-rate"],
+        lifetime = config["parameters"]["sweep"]["lifetime"],
+        availability = config["parameters"]["sweep"]["availability"]
+    output: directory("build/data/lcoe-sweep-eur-per-mwh.zarr")
+    conda: "../envs/default.yaml"
+    shell:
+        "python {input.script} sweep {input.capacity_factors} --investment_costs {params.investment_cost} "
+        "--annual_maintenance_costs {params.annual_maintenance_cost} --discount_rate {params.discount_rate} "
+        "--lifetime {params.lifetime} --availability {params.availability} --grid {output} "
+        + encoding_arguments("lcoe-sweep")
+
+
+rule lcoe_histogram:
+    message: "Stream LCOE into a histogram with fixed bins."
+    input:
+        script = "scripts/lcoe_ecdf.py",
+        lcoe = rules.lcoe.output[0]
+    output: "build/data/lcoe-histogram.csv"
+    conda: "../envs/default.yaml"
+    shell: "python {input.script} histogram {input.lcoe} {output}"
 
 
 rule lcoe_cdf:
     message: "Visualise the empiricial CDF of LCOE."
     input:
         script = "scripts/lcoe_ecdf.py",
-        lcoe = rules.lcoe.output[0]
+        histogram = rules.lcoe_histogram.output[0]
     output: "build/lcoe.png"
     conda: "../envs/default.yaml"
-    shell: "python {input} {params} {output}"
+    shell: "python {input} {output}"
 
 
 rule population_in_radius:
@@ -34,20 +71,77 @@ rule population_in_radius:
     input:
         script = "scripts/population.py",
         population = rules.population.output[0]
+    params:
+        kernel_cache = "build/data/kernels",
+        tile_size = config["execution"]["tile-size"]
     output: "build/population-within-{distance}km.tif"
+    threads: config["execution"]["workers"]
+    conda: "../envs/default.yaml"
+    shell:
+        "python {input} {wildcards.distance} {output} --kernel_cache {params.kernel_cache} "
+        "--tile_size {params.tile_size} --workers {threads} " + encoding_arguments("population-within-radius")
+
+
+rule population_in_radii:
+    message: "Create maps of population counts within all distances in one pass."
+    input:
+        script = "scripts/population.py",
+        population = rules.population.output[0]
+    params:
+        kernel_cache = rules.population_in_radius.params.kernel_cache,
+        tile_size = config["execution"]["tile-size"],
+        distances = config["parameters"]["distances-in-km"]
+    output: expand("build/population-within-{distance}km.tif", distance=config["parameters"]["distances-in-km"])
+    threads: config["execution"]["workers"]
     conda: "../envs/default.yaml"
-    shell: "python {input} {wildcards.distance} {output}"
+    shell:
+        "python {input} --distances {params.distances} --destination_paths {output} "
+        "--kernel_cache {params.kernel_cache} --tile_size {params.tile_size} --workers {threads} "
+        + encoding_arguments("population-within-radius")
+
+
+ruleorder: population_in_radii > population_in_radius
 
 
 rule disamenity_cost:
-    message: "Create map of disamenity cost."
+    message: "Create map of disamenity cost in a single convolution of the population."
     input:
         script = "scripts/disamenity_cost.py",
-        maps = expand("build/population-within-{distance}km.tif", distance=config["parameters"]["distances-in-km"])
-    params: distances = config["parameters"]["distances-in-km"]
+        population = rules.population.output[0]
+    params:
+        distances = config["parameters"]["distances-in-km"],
+        continuous = "--continuous" if config["parameters"]["disamenity-cost-function"] == "continuous" else "",
+        kernel_cache = rules.population_in_radius.params.kernel_cache,
+        tile_size = config["execution"]["tile-size"]
     output: "build/disamenity-cost.tif",
+    threads: config["execution"]["workers"]
     conda: "../envs/default.yaml"
-    shell: "python {input.script} {output} --source_paths {input.maps} --distances {params.distances}"
+    shell:
+        "python {input.script} {output} --population_path {input.population} --distances {params.distances} "
+        "{params.continuous} --kernel_cache {params.kernel_cache} --tile_size {params.tile_size} --workers {threads} "
+        + encoding_arguments("disamenity-cost")
+
+
+rule datacube:
+    message: "Combine all layers on the population grid into a single chunked datacube."
+    input:
+        script = "scripts/datacube.py",
+        capacity_factors = rules.capacity_factors.output[0],
+        lcoe = rules.lcoe.output.lcoe,
+        annual_energy = rules.lcoe.output.annual_energy,
+        disamenity_cost = rules.disamenity_cost.output[0],
+        population = expand("build/population-within-{distance}km.tif", distance=config["parameters"]["distances-in-km"])
+    params:
+        names = ["capacity-factors", "lcoe-eur-per-mwh", "annual-energy-mwh", "disamenity-cost"] + [
+            f"population-within-{distance}km" for distance in config["parameters"]["distances-in-km"]
+        ],
+        chunk_size = 1024
+    output: directory("build/data/datacube.zarr")
+    conda: "../envs/default.yaml"
+    shell:
+        "python {input.script} {output} --chunk_size {params.chunk_size} --names {params.names} "
+        "--paths_to_layers {input.capacity_factors} {input.lcoe} {input.annual_energy} {input.disamenity_cost} "
+        "{input.population}"
 
 
 rule country_shape:
@@ -65,6 +159,31 @@ rule country_shape:
     shell: "python {input} {wildcards.country_id} {params} {output}"
 
 
+rule country_shapes:
+    message: "Isolate all country shapes from NUTS at once."
+    input:
+        script = "scripts/country_shape.py",
+        shape = rules.nuts.output.shp,
+    params:
+        country_ids = config["country-ids"],
+        x_min = config["spatial-scope"]["x_min"],
+        x_max = config["spatial-scope"]["x_max"],
+        y_min = config["spatial-scope"]["y_min"],
+        y_max = config["spatial-scope"]["y_max"],
+        shape = lambda wildcards: rules.country_shape.output[0], # a function keeps the placeholder unexpanded
+        simplify_tolerance = config["country-shapes"]["simplification-tolerance"]
+    output:
+        gpkg = "build/data/shapes/countries.gpkg",
+        shapes = expand(rules.country_shape.output[0], country_id=config["country-ids"])
+    conda: "../envs/default.yaml"
+    shell:
+        "python {input} {params.country_ids} {params.x_min} {params.x_max} {params.y_min} {params.y_max} "
+        "{params.shape} --path_to_gpkg {output.gpkg} --simplify_tolerance {params.simplify_tolerance}"
+
+
+ruleorder: country_shapes > country_shape
+
+
 rule turbine_placement:
     message: "Determine locations of turbines in {wildcards.country_id}."
     input:
@@ -72,34 +191,233 @@ rule turbine_placement:
         shape = "build/data/shapes/{country_id}.shp",
         priors = rules.priors.output
     params:
-        turbine_separation_distance = config["parameters"]["turbine-separation-distance"]
+        turbine_separation_distance = config["parameters"]["turbine-separation-distance"],
+        exclusion_cache = "build/data/exclusions",
+        tile_size = config["execution"]["placement-tile-size-m"]
     output:
-        csv = "build/turbine-locations-{country_id}.csv",
+        table = "build/turbine-locations-{country_id}." + TABLE_SUFFIX,
         tif = "build/turbine-locations-{country_id}.tif"
+    threads: config["execution"]["workers"]
     conda: "../envs/glaes.yaml"
-    shell: "python {input} {params} {output}"
+    shell:
+        "python {input} {params.turbine_separation_distance} {output} "
+        "--exclusion_cache {params.exclusion_cache} --tile_size_m {params.tile_size} --workers {threads}"
+
+
+rule turbine_placement_all:
+    message: "Determine locations of turbines in all countries with warm worker processes."
+    input:
+        script = "scripts/turbine_locations.py",
+        shapes = expand(rules.turbine_placement.input.shape, country_id=config["country-ids"]),
+        priors = rules.priors.output
+    params:
+        # functions keep Snakemake from expanding the placeholder of these path templates
+        shape = lambda wildcards: rules.turbine_placement.input.shape,
+        turbine_separation_distance = config["parameters"]["turbine-separation-distance"],
+        table = lambda wildcards: rules.turbine_placement.output.table,
+        tif = lambda wildcards: rules.turbine_placement.output.tif,
+        exclusion_cache = rules.turbine_placement.params.exclusion_cache,
+        tile_size = rules.turbine_placement.params.tile_size,
+        country_ids = config["country-ids"]
+    output:
+        tables = expand(rules.turbine_placement.output.table, country_id=config["country-ids"]),
+        tifs = expand(rules.turbine_placement.output.tif, country_id=config["country-ids"])
+    threads: config["execution"]["workers"]
+    conda: "../envs/glaes.yaml"
+    shell:
+        "python {input.script} {params.shape} {input.priors} {params.turbine_separation_distance} "
+        "{params.table} {params.tif} --exclusion_cache {params.exclusion_cache} --workers {threads} "
+        "--tile_size_m {params.tile_size} --country_ids {params.country_ids}"
+
+
+ruleorder: turbine_placement_all > turbine_placement
+
+
+if config["execution"]["disamenity-method"] == "points":
+    MERGE_INPUT = [rules.lcoe.output.lcoe, rules.lcoe.output.annual_energy, rules.population.output[0]]
+    MERGE_METHOD = "points"
+    MERGE_FLAGS = "--continuous" if config["parameters"]["disamenity-cost-function"] == "continuous" else ""
+else: # samples all layers from the datacube
+    MERGE_INPUT = rules.datacube.output
+    MERGE_METHOD = "datacube"
+    MERGE_FLAGS = ""
 
 
 rule cost_per_turbine:
     message: "Spatially merge turbines and their costs."
     input:
         script = "scripts/merge.py",
-        turbines = rules.turbine_placement.output.csv,
-        lcoe = rules.lcoe.output.lcoe,
-        annual_energy = rules.lcoe.output.annual_energy,
-        disamenity_cost = rules.disamenity_cost.output,
-        population = expand("build/population-within-{distance}km.tif", distance=config["parameters"]["distances-in-km"])
-    params: distances = config["parameters"]["distances-in-km"]
-    output: "build/turbines-{country_id}.csv"
+        turbines = unpinned(rules.turbine_placement.output.table),
+        sources = MERGE_INPUT
+    params:
+        distances = config["parameters"]["distances-in-km"],
+        method = MERGE_METHOD,
+        flags = MERGE_FLAGS
+    output: "build/turbines-{country_id}." + TABLE_SUFFIX
+    conda: "../envs/default.yaml"
+    shell:
+        "python {input.script} {params.method} {input.turbines} {input.sources} {output} "
+        "--distances {params.distances} {params.flags}"
+
+
+rule cost_per_turbine_all:
+    message: "Spatially merge turbines and their costs for all countries at once."
+    input:
+        script = "scripts/merge.py",
+        turbines = expand(rules.turbine_placement.output.table, country_id=config["country-ids"]),
+        sources = MERGE_INPUT
+    params:
+        distances = config["parameters"]["distances-in-km"],
+        method = MERGE_METHOD,
+        flags = MERGE_FLAGS,
+        country_ids = config["country-ids"],
+        # functions keep Snakemake from expanding the placeholder of these path templates
+        turbines = lambda wildcards: rules.turbine_placement.output.table,
+        output = lambda wildcards: rules.cost_per_turbine.output[0]
+    output: expand(rules.cost_per_turbine.output[0], country_id=config["country-ids"])
+    conda: "../envs/default.yaml"
+    shell:
+        "python {input.script} {params.method} {params.turbines} {input.sources} {params.output} "
+        "--distances {params.distances} {params.flags} --country_ids {params.country_ids}"
+
+
+ruleorder: cost_per_turbine_all > cost_per_turbine
+
+
+rule generation_profiles:
+    message: "Aggregate hourly generation of turbines in {wildcards.country_id} by LCOE quantile."
+    input:
+        script = "scripts/timeseries.py",
+        time_series = rules.capacity_factor_time_series.output[0],
+        turbines = unpinned(rules.cost_per_turbine.output[0])
+    params:
+        n_bins = config["parameters"]["generation-profiles"]["lcoe-bins"],
+        availability = config["parameters"]["availability"]
+    output: "build/generation-profiles-{country_id}.nc"
+    conda: "../envs/default.yaml"
+    shell: "python {input} {params} {output}"
+
+
+rule cost_potential_curve_table:
+    message: "Build downsampled cost potential curve of {wildcards.country_id}."
+    input:
+        script = "scripts/plot.py",
+        turbines = unpinned(rules.cost_per_turbine.output[0])
+    output: "build/data/cost-potential-curve-{country_id}.csv"
+    conda: "../envs/default.yaml"
+    shell: "python {input.script} curve {input.turbines} {output}"
+
+
+rule sorted_costs:
+    message: "Sort costs of all turbines in {wildcards.country_id}."
+    input:
+        script = "scripts/supply_curve.py",
+        turbines = unpinned(rules.cost_per_turbine.output[0])
+    output:
+        engineering = "build/data/sorted-costs/{country_id}-engineering.npy",
+        total = "build/data/sorted-costs/{country_id}-total.npy"
+    conda: "../envs/default.yaml"
+    shell: "python {input.script} sort {input.turbines} {output.engineering} {output.total}"
+
+
+def region_country_ids(wildcards):
+    if wildcards.region == "EU":
+        return config["country-ids"]
+    return config["supply-curves"]["regions"][wildcards.region]
+
+
+rule regional_cost_potential_curve:
+    message: "Merge sorted costs of all turbines in {wildcards.region} into one cost potential curve."
+    input:
+        script = "scripts/supply_curve.py",
+        engineering = lambda wildcards: expand(
+            rules.sorted_costs.output.engineering, country_id=region_country_ids(wildcards)
+        ),
+        total = lambda wildcards: expand(rules.sorted_costs.output.total, country_id=region_country_ids(wildcards))
+    output: "build/data/cost-potential-curve-{region}.csv"
+    wildcard_constraints:
+        region = "|".join(["EU"] + list(config["supply-curves"]["regions"]))
+    conda: "../envs/default.yaml"
+    shell:
+        "python {input.script} {output} "
+        "--paths_to_engineering_cost {input.engineering} --paths_to_total_cost {input.total}"
+
+
+ruleorder: regional_cost_potential_curve > cost_potential_curve_table
+
+
+rule marginal_cost_of_targets:
+    message: "Determine marginal cost of meeting 2050 capacity targets."
+    input:
+        script = "scripts/supply_curve.py",
+        targets = "data/EU_wind_capacities_2050.csv",
+        engineering = expand(rules.sorted_costs.output.engineering, country_id=config["country-ids"]),
+        total = expand(rules.sorted_costs.output.total, country_id=config["country-ids"])
+    params:
+        country_ids = config["country-ids"]
+    output: "build/marginal-cost-of-2050-targets.csv"
     conda: "../envs/default.yaml"
-    shell: "python {input} {output} --distances {params.distances}"
+    shell:
+        "python {input.script} targets {input.targets} {output} --country_ids {params.country_ids} "
+        "--paths_to_engineering_cost {input.engineering} --paths_to_total_cost {input.total}"
 
 
 rule cost_potential_curve:
-    message: "Plot cost potential curve."
+    message: "Plot cost potential curve of {wildcards.country_id}."
     input:
         script = "scripts/plot.py",
-        turbines = rules.cost_per_turbine.output
+        curve = unpinned(rules.cost_potential_curve_table.output[0])
     output: "build/cost-potential-curve-{country_id}.png"
     conda: "../envs/default.yaml"
     shell: "python {input} {output}"
+
+
+rule regional_cost_potential_curve_plot:
+    message: "Plot cost potential curve of {wildcards.region}."
+    input:
+        script = "scripts/plot.py",
+        curve = rules.regional_cost_potential_curve.output[0]
+    output: "build/cost-potential-curve-{region}.png"
+    wildcard_constraints:
+        region = "|".join(["EU"] + list(config["supply-curves"]["regions"]))
+    conda: "../envs/default.yaml"
+    shell: "python {input} {output}"
+
+
+ruleorder: regional_cost_potential_curve_plot > cost_potential_curve
+
+
+rule cost_potential_curve_all:
+    message: "Build and plot cost potential curves of all countries in one interpreter."
+    input:
+        script = "scripts/cli.py",
+        turbines = expand(rules.cost_per_turbine.output[0], country_id=config["country-ids"])
+    params:
+        steps = " ".join(
+            f"'plot curve {turbines} {curve}' 'plot {curve} {figure}'"
+            for turbines, curve, figure in zip(
+                expand(rules.cost_per_turbine.output[0], country_id=config["country-ids"]),
+                expand(rules.cost_potential_curve_table.output[0], country_id=config["country-ids"]),
+                expand(rules.cost_potential_curve.output[0], country_id=config["country-ids"])
+            )
+        )
+    output:
+        curves = expand(rules.cost_potential_curve_table.output[0], country_id=config["country-ids"]),
+        figures = expand(rules.cost_potential_curve.output[0], country_id=config["country-ids"])
+    conda: "../envs/default.yaml"
+    shell: "python {input.script} batch {params.steps}"
+
+
+ruleorder: cost_potential_curve_all > cost_potential_curve
+ruleorder: cost_potential_curve_all > cost_potential_curve_table
+
+
+rule turbine_store:
+    message: "Store turbines of all countries in a spatial index for queries by polygon."
+    input:
+        script = "scripts/turbine_store.py",
+        turbines = expand(rules.cost_per_turbine.output[0], country_id=config["country-ids"])
+    params: country_ids = config["country-ids"]
+    output: "build/data/turbine-store.npz"
+    conda: "../envs/default.yaml"
+    shell: "python {input.script} {input.turbines} {output} --country_ids {params.country_ids}"
@@ -8,7 +8,7 @@ rule annual_capacity_factors:
         raw = rules.download_capacity_factors.output[0],
     output: "build/data/raw-annual-capacity-factors.tif"
     conda: "../envs/default.yaml"
-    shell: "python {input} {output}"
+    shell: "python {input} {output} " + encoding_arguments("capacity-factors")
 
 
 rule capacity_factors:
@@ -20,3 +20,13 @@ rule capacity_factors:
     conda: "../envs/default.yaml"
     shell: "rio warp {input.raw} -o {output} --like {input.reference} "
            "--src-nodata 65535.0 --dst-nodata nan --resampling average"
+
+
+rule capacity_factor_time_series:
+    message: "Store hourly capacity factors in a time-contiguous store."
+    input:
+        script = "scripts/timeseries.py",
+        raw = rules.download_capacity_factors.output[0],
+    output: directory("build/data/capacity-factor-time-series.zarr")
+    conda: "../envs/default.yaml"
+    shell: "python {input.script} store {input.raw} {output}"
@@ -0,0 +1,196 @@
+"""Benchmarks the dominant stages of the workflow on synthetic data and flags slowdowns against a baseline"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+from rasterio.crs import CRS
+from rasterio.transform import from_origin
+
+from file_management import write_tif, tif_values
+from population import generate_population_in_radii, within_radius_mask
+from disamenity_cost import calculate_disamenity_from_population, disamenity_at_points
+from lcoe import calculate_lcoe
+from merge import merge
+from plot import cost_potential_curve, plot
+
+CRS_EPSG3035 = CRS.from_epsg(3035)
+ORIGIN = (2500000, 5500000) # m; north-west corner of the synthetic rasters in EPSG3035
+SEED = 20210101
+LCOE_PARAMETERS = dict(
+    investment_costs=1040000,
+    annual_maintenance_costs=16800,
+    discount_rate=0.05,
+    lifetime=30,
+    availability=0.9,
+)
+
+
+def synthetic_inputs(directory: str, width: int, height: int, resolution_m: int, turbines: int) -> Dict[str, str]:
+    """Writes a sparse JRC-like population grid, capacity factors, and turbine locations."""
+    rng = np.random.default_rng(SEED)
+    transform = from_origin(*ORIGIN, resolution_m, resolution_m)
+
+    populated = rng.random((height, width)) < 0.25
+    population = np.where(populated, rng.lognormal(mean=2, sigma=1.5, size=(height, width)), 0).astype(np.float32)
+    capacity_factors = rng.beta(a=4, b=12, size=(height, width)).astype(np.float32)
+
+    rows = rng.integers(0, height, size=turbines)
+    cols = rng.integers(0, width, size=turbines)
+    locations = pd.DataFrame({
+        "x_m": ORIGIN[0] + (cols + 0.5) * resolution_m,
+        "y_m": ORIGIN[1] - (rows + 0.5) * resolution_m,
+    })
+
+    paths = {
+        "population": os.path.join(directory, "population.tif"),
+        "capacity_factors": os.path.join(directory, "capacity-factors.tif"),
+        "turbines": os.path.join(directory, "turbine-locations.csv"),
+    }
+    write_tif(paths["population"], population, transform=transform, crs=CRS_EPSG3035)
+    write_tif(paths["capacity_factors"], capacity_factors, transform=transform, crs=CRS_EPSG3035)
+    locations.to_csv(paths["turbines"])
+    return paths
+
+
+def measure(function: Callable, repeats: int) -> Dict[str, float]:
+    """Returns the fastest wall time of all repeats and peaks of memory.
+
+    The Python heap peak covers only memory allocated through Python, e.g. numpy arrays, but not buffers of GDAL
+    or FFT libraries. The peak resident set size covers all memory, but as the high-water mark of the process
+    it includes all earlier stages and only grows.
+    """
+    seconds = []
+    peaks = []
+    for _ in range(repeats):
+        tracemalloc.start()
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return {
+        "seconds": min(seconds),
+        "peak_python_heap_mb": max(peaks) / 1e6,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, # kB on Linux
+    }
+
+
+def partial_path(directory: str) -> Callable[[str], str]:
+    return lambda filename: os.path.join(directory, filename)
+
+
+def stages(paths: Dict[str, str], directory: str, distances: List[int], resolution_m: int) -> Dict[str, Callable]:
+    """Returns the functions the rules call, in the order of the workflow; stages read outputs of earlier ones."""
+    path = partial_path(directory)
+    population_paths = [path(f"population-within-{distance}km.tif") for distance in distances]
+    locations = pd.read_csv(paths["turbines"], index_col=0)
+    coordinates = list(zip(locations["x_m"], locations["y_m"]))
+    import matplotlib.pyplot # noqa: F401; plot imports it on first use, which should not count as plotting
+
+    def plot_curve():
+        cost_potential_curve(path("turbines.csv"), path("curve.csv"))
+        plot(path("curve.csv"), path("curve.png"))
+
+    return {
+        "within_radius_mask": lambda: [
+            within_radius_mask(radius=distance * 1000 / resolution_m) for distance in distances
+        ],
+        "generate_population_in_radii": lambda: generate_population_in_radii(
+            paths["population"], population_paths, distances
+        ),
+        "calculate_disamenity_from_population": lambda: calculate_disamenity_from_population(
+            distances, paths["population"], path("disamenity.tif")
+        ),
+        "disamenity_at_points": lambda: disamenity_at_points(
+            distances, paths["population"], locations["x_m"].values, locations["y_m"].values
+        ),
+        "calculate_lcoe": lambda: calculate_lcoe(
+            path_to_capacity_factors=paths["capacity_factors"],
+            path_to_output_lcoe=path("lcoe.tif"),
+            path_to_output_energy=path("annual-energy.tif"),
+            **LCOE_PARAMETERS
+        ),
+        "merge": lambda: merge(
+            distances=distances,
+            path_to_turbine_locations=paths["turbines"],
+            path_to_lcoe=path("lcoe.tif"),
+            path_to_annual_energy=path("annual-energy.tif"),
+            path_to_disamenity_cost=path("disamenity.tif"),
+            paths_to_population_by_distance=population_paths,
+            path_to_output=path("turbines.csv"),
+        ),
+        "tif_values": lambda: tif_values(path("lcoe.tif"), coordinates),
+        "plot": plot_curve,
+    }
+
+
+def slowdowns(results: List[dict], baseline: List[dict], threshold: float) -> List[dict]:
+    """Returns all stages that took more than (1 + threshold) times as long as in the baseline."""
+    baseline_seconds = {(result["scale"], result["stage"]): result["seconds"] for result in baseline}
+    flagged = []
+    for result in results:
+        reference = baseline_seconds.get((result["scale"], result["stage"]))
+        if reference and result["seconds"] > reference * (1 + threshold):
+            flagged.append(dict(result, baseline_seconds=reference, ratio=result["seconds"] / reference))
+    return flagged
+
+
+def benchmark(scales: List[List[str]], distances: List[int], repeats: int, path_to_output: str,
+              path_to_baseline: Optional[str] = None, threshold: float = 0.2):
+    results = []
+    for name, width, height, resolution_m, turbines in scales:
+        with tempfile.TemporaryDirectory() as directory:
+            paths = synthetic_inputs(directory, int(width), int(height), int(resolution_m), int(turbines))
+            for stage, function in stages(paths, directory, distances, int(resolution_m)).items():
+                result = dict(scale=name, stage=stage, **measure(function, repeats))
+                print(f"{name} {stage}: {result['seconds']:.2f} s, "
+                      f"{result['peak_python_heap_mb']:.0f} MB Python heap, {result['peak_rss_mb']:.0f} MB peak RSS")
+                results.append(result)
+
+    if path_to_baseline and os.path.exists(path_to_baseline):
+        with open(path_to_baseline, "r") as f:
+            flagged = slowdowns(results, json.load(f)["results"], threshold)
+    else:
+        flagged = []
+    for result in flagged:
+        print(f"Slowdown in {result['scale']} {result['stage']}: {result['ratio']:.2f} times the baseline")
+
+    with open(path_to_output, "w") as f:
+        json.dump(
+            {
+                "machine": {
+                    "platform": platform.platform(),
+                    "python": platform.python_version(),
+                    "cpus": os.cpu_count(),
+                },
+                "threshold": threshold,
+                "results": results,
+                "slowdowns": flagged,
+            },
+            f,
+            indent=2
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path_to_output", type=str)
+    parser.add_argument("--scale", dest="scales", nargs=5, action="append", required=True,
+                        metavar=("NAME", "WIDTH", "HEIGHT", "RESOLUTION_M", "TURBINES"))
+    parser.add_argument("--distances", type=int, nargs="+", default=[1, 2, 3, 4])
+    parser.add_argument("--repeats", type=int, default=1)
+    parser.add_argument("--path_to_baseline", type=str, default=None)
+    parser.add_argument("--threshold", type=float, default=0.2)
+
+    benchmark(
+        **vars(parser.parse_args())
+    )
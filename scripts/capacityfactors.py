@@ -3,28 +3,40 @@
 import argparse
 
 import numpy as np
-import pandas as pd
-import geopandas as gpd
 import xarray as xr
 import rioxarray # necessary for the rio accessor of DataArrays
-from shapely.geometry import Point
+from pyproj import Transformer
+
+import profiling
+from file_management import add_encoding_arguments, encode, encoding_profile, pop_encoding
+from file_management import RasterEncoding, DEFAULT_ENCODING
 
 
 DEPRECATED_GRID_SIZE_IN_M = 50000 # old style capacity factors are on a grid of 50km size
+TIME_CHUNK_SIZE = 24 * 7 * 4 # timesteps read at once when reducing the time series
 
 WGS84_EPSG = 4326
 WGS84 = f"EPSG:{WGS84_EPSG}"
 EPSG3035 = "EPSG:3035"
 
 
-def preprocess_capacity_factors(path_to_raw_cf: str, path_to_output: str):
-    ds = xr.open_dataset(path_to_raw_cf)
-    ds = ds.mean("time") # ASSUME average over 17 years
+def preprocess_capacity_factors(path_to_raw_cf: str, path_to_output: str, encoding: RasterEncoding = DEFAULT_ENCODING):
+    ds = xr.open_dataset(path_to_raw_cf, chunks={"time": TIME_CHUNK_SIZE}) # out-of-core, chunk by chunk
+    ds = ds.mean("time").compute() # ASSUME average over 17 years
     ds = ds.expand_dims(time=[1], axis=0) # re-add time dimension as function expects it
     da = convert_old_style_capacity_factor_time_series(ds)
     da = da.squeeze("timestep") # remove dummy time dimension
+    da = da.transpose('y', 'x')
+    da = da.copy(data=encode(da.values, encoding))
     da.rio.write_crs(EPSG3035, inplace=True)
-    da.transpose('y', 'x').rio.to_raster(path_to_output)
+    if encoding.nodata is not None:
+        da.rio.write_nodata(encoding.nodata, inplace=True)
+    if encoding.scale != 1:
+        da.attrs["scale_factor"] = encoding.scale
+    profile = encoding_profile(da.dtype, encoding)
+    profile.pop("nodata") # written above
+    profiling.output(path_to_output)
+    da.rio.to_raster(path_to_output, **profile)
 
 
 def convert_old_style_capacity_factor_time_series(ts):
@@ -48,21 +60,8 @@ def convert_old_style_capacity_factor_time_series(ts):
     This function takes data in the old format and converts them to the new format. The function is
     deprecated and should be removed as soon as the published data is updated with the new format.
     """
-    site_id_map = {
-        site_id.item(): (ts["lon"].sel(site_id=site_id).item(), ts["lat"].sel(site_id=site_id).item())
-        for site_id in ts.site_id
-    }
-
-    gdf = gpd.GeoDataFrame(
-        data={"site_id": [site_id for site_id in site_id_map.keys()]},
-        geometry=[Point(lon, lat) for lon, lat in site_id_map.values()],
-        crs=WGS84,
-    ).set_index("site_id").to_crs(EPSG3035) # type: ignore
-
-    gdf["x"] = [round(point.coords[0][0], ndigits=0) for point in gdf.geometry] # round to meter
-    gdf["y"] = [round(point.coords[0][1], ndigits=0) for point in gdf.geometry] # round to meter
-    ts["x"] = gdf["x"]
-    ts["y"] = gdf["y"]
+    x, y = site_coordinates(ts)
+    ts = ts.assign_coords(x=("site_id", x), y=("site_id", y))
     ts = ts.set_index(site_id=["x", "y"]).unstack("site_id")
     ts = ts["electricity"].rename(time="timestep")
 
@@ -79,11 +78,23 @@ def convert_old_style_capacity_factor_time_series(ts):
     return ts
 
 
+def site_coordinates(ts):
+    """Returns x and y coordinates of all sites of old style data in EPSG:3035, rounded to meters."""
+    lon, lat = ts["lon"], ts["lat"]
+    if "time" in lon.dims: # ASSUME site locations do not change over time
+        lon, lat = lon.isel(time=0), lat.isel(time=0)
+    x, y = Transformer.from_crs(WGS84, EPSG3035, always_xy=True).transform(lon.values, lat.values)
+    return np.round(x, decimals=0), np.round(y, decimals=0)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("path_to_raw_cf", type=str)
     parser.add_argument("path_to_output", type=str)
+    add_encoding_arguments(parser)
+    args = vars(parser.parse_args())
 
     preprocess_capacity_factors(
-        **vars(parser.parse_args())
+        encoding=pop_encoding(args),
+        **args
     )
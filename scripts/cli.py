@@ -0,0 +1,108 @@
+"""Single entry point to all scripts, importing heavy dependencies only for the script that is run
+
+Every subcommand takes the arguments of its script, e.g. `python scripts/cli.py plot curve <turbines> <output>`
+runs `python scripts/plot.py curve <turbines> <output>`. The batch subcommand runs a list of such steps in one
+interpreter, so that libraries are imported once and rasters read by one step are shared with later steps.
+"""
+
+import argparse
+import ast
+import os
+import runpy
+import shlex
+import sys
+from typing import List, Optional
+
+COMMANDS = { # subcommand: script module
+    "capacity-factors": "capacityfactors",
+    "time-series": "timeseries",
+    "lcoe": "lcoe",
+    "lcoe-ecdf": "lcoe_ecdf",
+    "population": "population",
+    "disamenity-cost": "disamenity_cost",
+    "datacube": "datacube",
+    "country-shape": "country_shape",
+    "turbine-locations": "turbine_locations",
+    "merge": "merge",
+    "plot": "plot",
+    "supply-curve": "supply_curve",
+    "turbine-store": "turbine_store",
+    "benchmark": "benchmark",
+    "profile-report": "profiling",
+}
+SCRIPTS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+RASTER_CACHE_GB = 4
+
+
+def description(module: str) -> str:
+    """Returns the docstring of a script without importing it."""
+    with open(os.path.join(SCRIPTS_DIRECTORY, module + ".py"), "r") as f:
+        return ast.get_docstring(ast.parse(f.read())) or ""
+
+
+def script_path(command: str) -> str:
+    return os.path.join(SCRIPTS_DIRECTORY, COMMANDS[command] + ".py")
+
+
+def run(command: str, arguments: List[str]):
+    """Runs a script as if it had been called from the command line with the arguments."""
+    sys.argv = [script_path(command)] + arguments
+    runpy.run_module(COMMANDS[command], run_name="__main__", alter_sys=True)
+
+
+def read_steps(path_to_steps: str) -> List[str]:
+    """Reads one step per line, ignoring empty lines and comments."""
+    with open(path_to_steps, "r") as f:
+        lines = [line.strip() for line in f]
+    return [line for line in lines if line and not line.startswith("#")]
+
+
+def batch(steps: List[str], path_to_steps: Optional[str] = None, raster_cache_gb: float = RASTER_CACHE_GB):
+    """Runs the steps in the file, followed by the given steps, in this interpreter and stops at the first failure."""
+    import file_management
+    import profiling
+
+    if path_to_steps:
+        steps = read_steps(path_to_steps) + steps
+    if raster_cache_gb > 0:
+        file_management.enable_raster_cache(int(raster_cache_gb * 2**30))
+
+    argv = sys.argv
+    for number, step in enumerate(steps, start=1):
+        command, *arguments = shlex.split(step)
+        if command not in COMMANDS:
+            raise SystemExit(f"Step {number} '{step}': unknown command {command}.")
+        print(f"Step {number}/{len(steps)}: {step}", flush=True)
+        sys.argv = [script_path(command)] + arguments
+        profiling.restart() # one profile per step, written next to the outputs of the step
+        try:
+            run(command, arguments)
+        except SystemExit as error:
+            if error.code not in (None, 0):
+                raise SystemExit(f"Step {number} '{step}' failed with exit code {error.code}.")
+        finally:
+            sys.argv = argv
+
+
+def parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", metavar="command", required=True)
+    for command, module in COMMANDS.items():
+        subparsers.add_parser(command, help=description(module).splitlines()[0], add_help=False)
+    batch_parser = subparsers.add_parser("batch", help="Run several steps in one interpreter.")
+    batch_parser.add_argument("steps", type=str, nargs="*", help="subcommand and its arguments, quoted")
+    batch_parser.add_argument("--path_to_steps", type=str, default=None, help="file with one step per line")
+    batch_parser.add_argument("--raster_cache_gb", type=float, default=RASTER_CACHE_GB,
+                              help="memory for rasters shared between steps; 0 disables sharing")
+    return parser
+
+
+if __name__ == "__main__" and sys.argv[1:2] and sys.argv[1] in COMMANDS:
+    run(sys.argv[1], sys.argv[2:])
+elif __name__ == "__main__":
+    args = vars(parser().parse_args())
+    args.pop("command")
+
+    batch(
+        **args
+    )
@@ -1,37 +1,60 @@
 """Generates a single shape file per country from individual NUTS shapes"""
 
 import argparse
+from typing import List, Optional
 
 from shapely.geometry import box
 import geopandas as gpd
 
+import profiling
+
 
 def isolate_country_shape(path_to_nuts, country_id, x_min, x_max, y_min, y_max, path_to_output):
+    isolate_country_shapes(path_to_nuts, [country_id], x_min, x_max, y_min, y_max, path_to_output)
+
+
+def isolate_country_shapes(path_to_nuts: str, country_ids: List[str], x_min: float, x_max: float, y_min: float,
+                           y_max: float, path_to_output: str, path_to_gpkg: Optional[str] = None,
+                           simplify_tolerance: float = 0):
+    """Isolates all countries reading and clipping NUTS only once.
+
+    The output path contains the placeholder `{country_id}` if there is more than one country. All countries
+    can additionally be written to a single GeoPackage (with spatial index). A positive tolerance (in units
+    of the NUTS CRS) simplifies shapes while preserving their topology.
+    """
+    assert len(country_ids) == 1 or "{country_id}" in path_to_output, \
+        'path_to_output must contain {country_id} if there is more than one country'
     # As GLAES requires single polygons, we are isolating countries here.
-    shape = (
+    shapes = (
         gpd
         .read_file(path_to_nuts)
         .set_index("NUTS_ID")
-        .loc[[country_id], :]
+        .loc[country_ids, :]
     )
     continental_europe = box(x_min, y_min, x_max, y_max)
-    (
-        gpd
-        .clip(shape, continental_europe)
-        .to_file(path_to_output)
-    )
+    shapes = gpd.clip(shapes, continental_europe)
+    if simplify_tolerance > 0:
+        shapes.geometry = shapes.geometry.simplify(simplify_tolerance, preserve_topology=True)
+
+    if path_to_gpkg is not None:
+        shapes.to_file(path_to_gpkg, driver="GPKG", layer="countries")
+    for country_id in country_ids:
+        profiling.output(path_to_output.format(country_id=country_id))
+        shapes.loc[[country_id], :].to_file(path_to_output.format(country_id=country_id))
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("path_to_nuts", type=str)
-    parser.add_argument("country_id", type=str)
+    parser.add_argument("country_ids", type=str, nargs="+")
     parser.add_argument("x_min", type=float)
     parser.add_argument("x_max", type=float)
     parser.add_argument("y_min", type=float)
     parser.add_argument("y_max", type=float)
     parser.add_argument("path_to_output", type=str)
+    parser.add_argument("--path_to_gpkg", type=str, default=None)
+    parser.add_argument("--simplify_tolerance", type=float, default=0)
 
-    isolate_country_shape(
+    isolate_country_shapes(
         **vars(parser.parse_args())
     )
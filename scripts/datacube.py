@@ -0,0 +1,93 @@
+"""Combines aligned raster layers into a single chunked datacube and samples all layers at coordinates"""
+
+import argparse
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import rioxarray # necessary for the rio accessor of DataArrays
+from affine import Affine
+
+import profiling
+
+LCOE_LAYER = "lcoe-eur-per-mwh"
+ANNUAL_ENERGY_LAYER = "annual-energy-mwh"
+DISAMENITY_COST_LAYER = "disamenity-cost"
+
+
+def population_layer(distance: int) -> str:
+    return f"population-within-{distance}km"
+
+
+def build_datacube(paths_to_layers: List[str], names: List[str], path_to_output: str, chunk_size: int):
+    """Writes all layers as named variables of one chunked Zarr store.
+
+    All layers must be on the same grid; nodata is stored as NaN. The transform (in GDAL order) and the CRS
+    are stored in the attributes of the datacube.
+    """
+    assert len(paths_to_layers) == len(names), \
+        f'paths_to_layers (len = {len(paths_to_layers)}) and names {len(names)} have different length'
+    chunks = {"x": chunk_size, "y": chunk_size}
+    layers = [
+        rioxarray.open_rasterio(path, mask_and_scale=True, chunks=chunks).squeeze("band", drop=True)
+        for path in paths_to_layers
+    ]
+    reference = layers[0]
+    for name, layer in zip(names, layers):
+        assert layer.rio.crs == reference.rio.crs, f'Layer {name} has a different crs'
+        assert layer.rio.transform() == reference.rio.transform(), f'Layer {name} has a different transform'
+        assert layer.shape == reference.shape, f'Layer {name} has a different shape'
+
+    datacube = xr.Dataset(
+        {name: layer.drop_vars("spatial_ref").rename(name) for name, layer in zip(names, layers)},
+        attrs={
+            "transform": reference.rio.transform().to_gdal(),
+            "crs": reference.rio.crs.to_wkt(),
+        }
+    )
+    for name in names:
+        datacube[name].attrs = {}
+        datacube[name].encoding = {}
+    profiling.output(path_to_output)
+    datacube.to_zarr(path_to_output, mode="w", consolidated=True)
+
+
+def open_datacube(path_to_datacube: str) -> xr.Dataset:
+    """Opens the datacube lazily; chunks are read only when values are accessed."""
+    return xr.open_zarr(path_to_datacube, consolidated=True)
+
+
+def sample_datacube(datacube: xr.Dataset, xs: np.ndarray, ys: np.ndarray,
+                    names: Optional[List[str]] = None) -> pd.DataFrame:
+    """Returns the values of all (or the named) layers at the coordinates in a single indexed read.
+
+    Values of points outside the datacube are NaN.
+    """
+    names = list(datacube.data_vars) if names is None else names
+    transform = Affine.from_gdal(*datacube.attrs["transform"])
+    cols, rows = ~transform * (np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64))
+    rows = np.floor(rows).astype(np.int64)
+    cols = np.floor(cols).astype(np.int64)
+    inside = (rows >= 0) & (rows < datacube.sizes["y"]) & (cols >= 0) & (cols < datacube.sizes["x"])
+
+    values = datacube[names].isel(
+        y=xr.DataArray(rows[inside], dims="point"),
+        x=xr.DataArray(cols[inside], dims="point"),
+    ).compute()
+    samples = pd.DataFrame(np.nan, index=pd.RangeIndex(len(rows)), columns=names)
+    for name in names:
+        samples.loc[inside, name] = values[name].values
+    return samples
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path_to_output", type=str)
+    parser.add_argument("--paths_to_layers", type=str, nargs="*")
+    parser.add_argument("--names", type=str, nargs="*")
+    parser.add_argument("--chunk_size", type=int, default=1024)
+
+    build_datacube(
+        **vars(parser.parse_args())
+    )
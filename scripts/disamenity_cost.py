@@ -2,9 +2,22 @@
 
 import argparse
 
+from functools import partial
+from typing import List, Tuple
+
 import numpy as np
+import rasterio.transform
+from scipy.spatial import cKDTree
+
+from file_management import write_tif, tif_data, tif_transform, tif_crs
+from file_management import add_encoding_arguments, pop_encoding, DEFAULT_ENCODING
+from population import cached_within_radius_mask, convolve_wrap_fft, within_radius_mask
+from tiling import convolve_tiled, map_tiled
+
 
-from file_management import write_tif, tif_data, tif_transform, tif_crs, tif_values
+MINIMAL_DISTANCE_IN_KM = 0.2 # disamenity costs of population closer than this are capped
+CONTINUOUS_RING_WIDTH_IN_KM = 0.1 # width of the rings approximating the continuous cost function
+NEIGHBOURS_PER_QUERY = 20_000_000 # pairs of point and populated cell held in memory at once
 
 
 def disamenity_costs(radius_from, radius_to) -> float:
@@ -33,14 +46,40 @@ def disamenity_costs(radius_from, radius_to) -> float:
     return area_weighted_costs
 
 
-def calculate_disamenity(distances, source_paths, destination_path):
+def _ring_disamenity(*populations_within_distances: np.ndarray, costs: List[float]) -> np.ndarray:
+    # Weights the population between consecutive distances with the disamenity cost of each ring
+    previous_population = 0
+    cumulated_disamenity = 0
+    for population, cost in zip(populations_within_distances, costs):
+        cumulated_disamenity += (population - previous_population) * cost
+        previous_population = population
+    return cumulated_disamenity
+
+
+def calculate_disamenity(distances, source_paths, destination_path, tile_size=0, workers=1, encoding=DEFAULT_ENCODING):
     # Calculates the disamenity costs in €/turbine/year
 
     assert len(distances) == len(source_paths), f'distances (len = {len(distances)}) and source_paths {len(source_paths)} have differnet length'
     assert distances == sorted(distances), f'distances should be sorted form smallest to greatest, whereas I got {distances}'
 
-    previous_source_path = None
-    previous_distance    = 0.2
+    if tile_size > 0: # out-of-core
+        map_tiled(
+            partial(
+                _ring_disamenity,
+                costs=[disamenity_costs(radius_from, radius_to)
+                       for radius_from, radius_to in zip([MINIMAL_DISTANCE_IN_KM] + distances[:-1], distances)]
+            ),
+            source_paths=source_paths,
+            destination_path=destination_path,
+            dtype=np.float64,
+            tile_size=tile_size,
+            workers=workers,
+            encoding=encoding,
+        )
+        return
+
+    previous_population  = 0
+    previous_distance    = MINIMAL_DISTANCE_IN_KM
     previous_transform   = None
     previous_crs         = None
 
@@ -49,12 +88,11 @@ def calculate_disamenity(distances, source_paths, destination_path):
     for distance, source_path in zip(distances, source_paths):
 
         # Population in a counted between two distances
-        population = tif_data(source_path) - (tif_data(previous_source_path) if previous_source_path is not None else 0)
+        population_within_distance = tif_data(source_path)
+        population = population_within_distance - previous_population
         disamenity = disamenity_costs(radius_from=previous_distance, radius_to=distance)
 
         # Sums in every iteration the disamenity
-        print(f'QA disamenity cost map {disamenity}')
-        print(tif_values(full_path=source_path, coordinates=[(4214100, 3539499), (4214700, 3539099)]))
         cumulated_disamenity += population * disamenity
 
         # QA that affine transform matrices are consistent
@@ -65,7 +103,7 @@ def calculate_disamenity(distances, source_paths, destination_path):
         assert (crs       == previous_crs      ) | (previous_crs       is None), 'You are iterating over .tif files that have different crs properties'
 
         # Setting the next iteration
-        previous_source_path = source_path
+        previous_population = population_within_distance
         previous_distance = distance
         previous_transform = transform
         previous_crs = crs
@@ -75,15 +113,176 @@ def calculate_disamenity(distances, source_paths, destination_path):
         data=cumulated_disamenity, # type: ignore
         transform=transform, # type: ignore
         crs=crs, # type: ignore
+        encoding=encoding,
     )
 
 
+def disamenity_kernel(distances, resolution, continuous=False, kernel_cache=None) -> np.ndarray:
+    # Returns the kernel weighting population by its disamenity costs in €/turbine/person/year
+    #
+    # The kernel is the sum of the masks of all rings between consecutive distances (in km), each weighted by
+    # the disamenity costs of the ring. Because convolution is linear, a single convolution of the population
+    # with this kernel equals the sum of the population in each ring weighted by its costs. If continuous, the
+    # cost function is evaluated on thin rings instead of the rings given by distances.
+    if continuous:
+        n_rings = int(round((max(distances) - MINIMAL_DISTANCE_IN_KM) / CONTINUOUS_RING_WIDTH_IN_KM))
+        radii = np.linspace(MINIMAL_DISTANCE_IN_KM, max(distances), num=n_rings + 1)
+        radii_from, radii_to = radii[:-1], radii[1:]
+        masks = [within_radius_mask(radius=radius / resolution, decimals=None) for radius in radii_to]
+    else:
+        radii_from, radii_to = [MINIMAL_DISTANCE_IN_KM] + list(distances[:-1]), distances
+        masks = [cached_within_radius_mask(radius=radius, resolution=resolution, path_to_cache=kernel_cache)
+                 for radius in radii_to]
+
+    size = max(mask.shape[0] for mask in masks)
+    kernel = np.zeros((size, size), dtype=np.float64)
+    previous_mask = np.zeros_like(kernel)
+    for radius_from, radius_to, mask in zip(radii_from, radii_to, masks):
+        padding = (size - mask.shape[0]) // 2
+        mask = np.pad(mask, padding)
+        kernel += (mask - previous_mask) * disamenity_costs(radius_from=radius_from, radius_to=radius_to)
+        previous_mask = mask
+    return kernel
+
+
+def calculate_disamenity_from_population(distances, population_path, destination_path, continuous=False,
+                                         kernel_cache=None, tile_size=0, workers=1, encoding=DEFAULT_ENCODING):
+    # Calculates the disamenity costs in €/turbine/year in a single convolution of the population
+    assert distances == sorted(distances), \
+        f'distances should be sorted form smallest to greatest, whereas I got {distances}'
+
+    transform = tif_transform(population_path)
+    resolution_in_km = abs(transform.a) / 1000 # EPSG3035's unit is meters
+    kernel = disamenity_kernel(distances, resolution=resolution_in_km, continuous=continuous,
+                               kernel_cache=kernel_cache)
+
+    if tile_size > 0: # out-of-core
+        convolve_tiled(population_path, destination_path, kernel=kernel, tile_size=tile_size, workers=workers,
+                       encoding=encoding)
+        return
+
+    population = tif_data(population_path, replace_nodata=0)
+    write_tif(
+        full_path=destination_path,
+        data=convolve_wrap_fft(np.fft.rfft2(population.astype(np.float64)), shape=population.shape, kernel=kernel),
+        transform=transform,
+        crs=tif_crs(population_path),
+        encoding=encoding,
+    )
+
+
+def continuous_disamenity_costs(distance) -> np.ndarray:
+    # Returns the disamenity costs in €/turbine/person/year of a person at distance (in km) of a turbine
+    d0 = 4
+    a = - 3.6
+    c = - a * np.log(d0)
+    return a * np.log(np.maximum(distance, MINIMAL_DISTANCE_IN_KM)) + c
+
+
+def populated_cells(population_path) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Returns x and y (in m) of the centres of all populated cells and their population
+    population = tif_data(population_path, replace_nodata=0)
+    rows, cols = np.nonzero(population > 0)
+    xs, ys = rasterio.transform.xy(tif_transform(population_path), rows, cols, offset="center")
+    return np.asarray(xs), np.asarray(ys), population[rows, cols].astype(np.float64)
+
+
+def disamenity_at_points(distances, population_path, xs, ys, continuous=False,
+                         neighbours_per_query=NEIGHBOURS_PER_QUERY) -> Tuple[np.ndarray, np.ndarray]:
+    # Returns the population within each distance (in km) of each point, and the disamenity costs in €/turbine/year
+    #
+    # Instead of convolving the entire population raster, all populated cells within the largest distance of
+    # each point are found in a KD-tree and weighted by the exact distance between point and cell centre.
+    # Effort hence scales with the number of points rather than with the raster area. Points are processed in
+    # batches of at most neighbours_per_query pairs of point and cell, so that memory does not grow with the
+    # population density around the points.
+    assert distances == sorted(distances), \
+        f'distances should be sorted form smallest to greatest, whereas I got {distances}'
+    cell_xs, cell_ys, cell_population = populated_cells(population_path)
+    tree = cKDTree(np.column_stack([cell_xs, cell_ys]))
+    binned_costs = np.array([
+        disamenity_costs(radius_from, radius_to)
+        for radius_from, radius_to in zip([MINIMAL_DISTANCE_IN_KM] + list(distances[:-1]), distances)
+    ])
+
+    population_within_distances = np.zeros((len(xs), len(distances)), dtype=np.float64)
+    disamenity = np.zeros(len(xs), dtype=np.float64)
+    number_neighbours = tree.query_ball_point(
+        np.column_stack([xs, ys]), r=max(distances) * 1000, return_length=True
+    )
+    for start, stop in neighbour_batches(number_neighbours, neighbours_per_query):
+        points = np.column_stack([xs[start:stop], ys[start:stop]])
+        neighbours = tree.query_ball_point(points, r=max(distances) * 1000, return_sorted=False)
+        point_index = np.repeat(np.arange(len(points)), [len(cells) for cells in neighbours])
+        cell_index = np.concatenate(neighbours).astype(np.int64) # empty lists concatenate to floats
+        distance = np.hypot(
+            points[point_index, 0] - cell_xs[cell_index],
+            points[point_index, 1] - cell_ys[cell_index]
+        ) / 1000 # EPSG3035's unit is meters
+        population = cell_population[cell_index]
+
+        for i, radius in enumerate(distances):
+            population_within_distances[start:start + len(points), i] = np.bincount(
+                point_index, weights=population * (distance <= radius), minlength=len(points)
+            )
+        if continuous:
+            cost = continuous_disamenity_costs(distance)
+        else:
+            ring = np.searchsorted(distances, distance, side="left")
+            cost = binned_costs[np.minimum(ring, len(distances) - 1)] # guards against rounding at the outer radius
+        disamenity[start:start + len(points)] = np.bincount(
+            point_index, weights=population * cost, minlength=len(points)
+        )
+    return population_within_distances, disamenity
+
+
+def neighbour_batches(number_neighbours, neighbours_per_query) -> List[Tuple[int, int]]:
+    # Returns start and stop of consecutive batches of points whose neighbours sum to at most neighbours_per_query
+    # A single point with more neighbours than that forms a batch on its own.
+    batches = []
+    start = 0
+    cumulative = np.cumsum(number_neighbours)
+    while start < len(number_neighbours):
+        offset = cumulative[start - 1] if start > 0 else 0
+        stop = int(np.searchsorted(cumulative, offset + neighbours_per_query, side="right"))
+        stop = max(stop, start + 1)
+        batches.append((start, stop))
+        start = stop
+    return batches
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--source_paths", type=str, nargs="*")
+    parser.add_argument("--population_path", type=str, default=None)
     parser.add_argument("--distances", type=int, nargs="*")
+    parser.add_argument("--continuous", action="store_true")
+    parser.add_argument("--kernel_cache", type=str, default=None)
     parser.add_argument("destination_path", type=str)
+    parser.add_argument("--tile_size", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=1)
+    add_encoding_arguments(parser)
+    args = parser.parse_args()
+    encoding = pop_encoding(vars(args))
 
-    calculate_disamenity(
-        **vars(parser.parse_args())
-    )
+    if args.population_path is not None: # single convolution with combined kernel
+        calculate_disamenity_from_population(
+            distances=args.distances,
+            population_path=args.population_path,
+            destination_path=args.destination_path,
+            continuous=args.continuous,
+            kernel_cache=args.kernel_cache,
+            tile_size=args.tile_size,
+            workers=args.workers,
+            encoding=encoding,
+        )
+    else:
+        assert not args.continuous, 'the continuous cost function requires the population_path'
+        calculate_disamenity(
+            distances=args.distances,
+            source_paths=args.source_paths,
+            destination_path=args.destination_path,
+            tile_size=args.tile_size,
+            workers=args.workers,
+            encoding=encoding,
+        )
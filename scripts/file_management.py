@@ -1,15 +1,21 @@
 """Collects functions used to extract zip files and interact with raster files"""
 
+import argparse
 import os
 import rasterio
 import rasterio.crs
+import rasterio.shutil
 
 import numpy as np
 
-from typing import List
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
 from affine import Affine
 from zipfile import ZipFile
 
+import profiling
+
 
 def unzip_file(file_name, archive, destination_folder) -> str:
     file_full_path = os.path.join(destination_folder, file_name)
@@ -30,9 +36,16 @@ def unzip_file(file_name, archive, destination_folder) -> str:
 
 def tif_data(full_path, replace_nodata=None):
     with rasterio.open(full_path) as dataset:
-        # Only 1 band supported
-        index, = dataset.indexes
-        data = dataset.read(index)
+        data = _raster_cache.get(full_path) if _raster_cache is not None else None
+        if data is None:
+            # Only 1 band supported
+            index, = dataset.indexes
+            with profiling.phase("read"):
+                data = dataset.read(index)
+            profiling.bytes_read(full_path, data.nbytes)
+            data = decode(data, dataset)
+            if _raster_cache is not None:
+                _raster_cache.put(full_path, data)
         if replace_nodata is not None:
             data = np.where(data == dataset.nodata, replace_nodata, data)
     return data
@@ -50,39 +63,338 @@ def tif_crs(full_path):
     return crs
 
 
+class RasterSampler:
+    """Samples values of single-band rasters at coordinates.
+
+    Only blocks that contain points are read. Opened datasets and decoded blocks are kept in least-recently-used
+    caches, so that repeated sampling of the same rasters does not decompress blocks again.
+    """
+
+    def __init__(self, max_datasets: int = 32, max_block_bytes: int = 512 * 2**20):
+        self.max_datasets = max_datasets
+        self.max_block_bytes = max_block_bytes
+        self._datasets: "OrderedDict[str, rasterio.io.DatasetReader]" = OrderedDict()
+        self._stamps: Dict[str, Tuple[int, int]] = {}
+        self._blocks: "OrderedDict[Tuple[str, int, int], np.ndarray]" = OrderedDict()
+        self._block_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        for dataset in self._datasets.values():
+            dataset.close()
+        self._datasets.clear()
+        self._stamps.clear()
+        self._blocks.clear()
+        self._block_bytes = 0
+
+    def _forget(self, full_path: str):
+        # drops the dataset and all blocks of a file that has changed since it has been opened
+        if full_path in self._datasets:
+            self._datasets.pop(full_path).close()
+        for key in [key for key in self._blocks if key[0] == full_path]:
+            self._block_bytes -= self._blocks.pop(key).nbytes
+
+    def _dataset(self, full_path: str) -> rasterio.io.DatasetReader:
+        stamp = _file_stamp(full_path)
+        if self._stamps.get(full_path, stamp) != stamp:
+            self._forget(full_path)
+        self._stamps[full_path] = stamp
+        if full_path in self._datasets:
+            self._datasets.move_to_end(full_path)
+        else:
+            self._datasets[full_path] = rasterio.open(full_path)
+            if len(self._datasets) > self.max_datasets:
+                _, dataset = self._datasets.popitem(last=False)
+                dataset.close()
+        return self._datasets[full_path]
+
+    def _block(self, full_path: str, block_row: int, block_col: int) -> np.ndarray:
+        key = (full_path, block_row, block_col)
+        if key in self._blocks:
+            self._blocks.move_to_end(key)
+            return self._blocks[key]
+        dataset = self._dataset(full_path)
+        index, = dataset.indexes # Only 1 band supported
+        with profiling.phase("read"):
+            block = dataset.read(index, window=dataset.block_window(index, block_row, block_col))
+        profiling.bytes_read(full_path, block.nbytes)
+        block = decode(block, dataset)
+        self._blocks[key] = block
+        self._block_bytes += block.nbytes
+        while self._block_bytes > self.max_block_bytes and len(self._blocks) > 1:
+            _, evicted = self._blocks.popitem(last=False)
+            self._block_bytes -= evicted.nbytes
+        return block
+
+    def sample(self, full_path: str, xs: np.ndarray, ys: np.ndarray) -> np.ma.MaskedArray:
+        """Returns the values at the coordinates, masking nodata and points outside the raster."""
+        dataset = self._dataset(full_path)
+        cols, rows = ~dataset.transform * (np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64))
+        rows = np.floor(rows).astype(np.int64)
+        cols = np.floor(cols).astype(np.int64)
+        inside = (rows >= 0) & (rows < dataset.height) & (cols >= 0) & (cols < dataset.width)
+
+        dtype = np.dtype(dataset.dtypes[0]) if dataset.scales[0] == 1 else np.dtype(np.float64)
+        if dataset.nodata is not None:
+            fill_value = dataset.nodata
+        else:
+            fill_value = np.nan if np.issubdtype(dtype, np.floating) else 0
+        values = np.full(len(rows), fill_value, dtype=dtype)
+
+        index, = dataset.indexes
+        block_height, block_width = dataset.block_shapes[index - 1]
+        block_rows, block_cols = rows // block_height, cols // block_width
+        block_ids = block_rows * (dataset.width // block_width + 1) + block_cols
+        points = np.flatnonzero(inside)
+        order = np.argsort(block_ids[points], kind="stable")
+        points = points[order]
+        for in_block in np.split(points, np.flatnonzero(np.diff(block_ids[points])) + 1):
+            if len(in_block) == 0:
+                continue
+            block = self._block(full_path, block_rows[in_block[0]], block_cols[in_block[0]])
+            values[in_block] = block[rows[in_block] % block_height, cols[in_block] % block_width]
+
+        mask = ~inside
+        if dataset.nodata is not None:
+            mask |= (values == dataset.nodata)
+        if np.issubdtype(dtype, np.floating):
+            mask |= np.isnan(values)
+        return np.ma.MaskedArray(values, mask=mask)
+
+    def sample_all(self, full_paths: List[str], xs: np.ndarray, ys: np.ndarray) -> Dict[str, np.ma.MaskedArray]:
+        """Returns the values of several rasters at the same coordinates."""
+        return {full_path: self.sample(full_path, xs, ys) for full_path in full_paths}
+
+
+def _file_stamp(full_path: str) -> Tuple[int, int]:
+    stat = os.stat(full_path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+class RasterCache:
+    """Least-recently-used cache of entire rasters, invalidated when a file changes.
+
+    Cached rasters are read-only, as they are shared by all callers.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._rasters: "OrderedDict[Tuple[str, int, int], np.ndarray]" = OrderedDict()
+        self._bytes = 0
+
+    def get(self, full_path: str) -> Optional[np.ndarray]:
+        key = (os.path.abspath(full_path), *_file_stamp(full_path))
+        if key not in self._rasters:
+            return None
+        self._rasters.move_to_end(key)
+        return self._rasters[key]
+
+    def put(self, full_path: str, data: np.ndarray):
+        key = (os.path.abspath(full_path), *_file_stamp(full_path))
+        data.setflags(write=False)
+        self._rasters[key] = data
+        self._bytes += data.nbytes
+        while self._bytes > self.max_bytes and len(self._rasters) > 1:
+            _, evicted = self._rasters.popitem(last=False)
+            self._bytes -= evicted.nbytes
+
+
+_raster_cache: Optional[RasterCache] = None
+_shared_sampler: Optional[RasterSampler] = None
+
+
+def enable_raster_cache(max_bytes: int = 4 * 2**30):
+    """Shares rasters read by `tif_data` and blocks sampled through `raster_sampler` across calls.
+
+    Useful when several steps run in the same interpreter and read the same rasters.
+    """
+    global _raster_cache, _shared_sampler
+    _raster_cache = RasterCache(max_bytes)
+    _shared_sampler = RasterSampler()
+
+
+@contextmanager
+def raster_sampler() -> Iterator[RasterSampler]:
+    """Yields the shared sampler if the raster cache is enabled, and otherwise a sampler closed on exit."""
+    if _shared_sampler is not None:
+        yield _shared_sampler
+        return
+    with RasterSampler() as sampler:
+        yield sampler
+
+
 def tif_values(full_path: str, coordinates: List[tuple]) -> List[float]:
     """Returns the values correspoing to the input coordinates"""
-    
+
     # Decompose into x and y coordinates
-    xs, ys = np.array(coordinates).transpose() 
-    
-    with rasterio.open(full_path) as src:
-        rows, cols = rasterio.transform.rowcol(src.transform, xs, ys) # type: ignore
-        index, = src.indexes
-        data = src.read(index)
+    xs, ys = np.array(coordinates).transpose()
 
-    return [data[row, col] for row, col in zip(rows, cols)]
+    with raster_sampler() as sampler:
+        return list(sampler.sample(full_path, xs, ys).data)
 
 
-def write_tif(full_path: str, data: np.ndarray, transform: Affine, crs: rasterio.crs.CRS):
-    # https://rasterio.readthedocs.io/en/latest/quickstart.html#opening-a-dataset-in-writing-mode
+BLOCK_SIZE = 512
+OVERVIEW_LEVELS = [2, 4, 8, 16, 32]
+LEVEL_OPTIONS = {"deflate": "zlevel", "zstd": "zstd_level"}
 
-    height, width = data.shape
-    dtype = data.dtype
-    print("Called write_tif with ouput path:", full_path)
-    with rasterio.open(
+
+class RasterEncoding(NamedTuple):
+    """How a raster is stored on disk.
+
+    Data can be stored divided by `scale`, typically floats as integers. The scale is written to the GeoTIFF
+    and all readers in this module return unscaled values.
+    """
+    dtype: Optional[str] = None # None keeps the dtype of the data
+    scale: float = 1 # stored value = value / scale, rounded for integer dtypes
+    nodata: Optional[float] = None
+    compress: str = "deflate" # deflate, zstd, or lzw
+    level: Optional[int] = None # None uses the default level of the codec
+    predictor: Optional[int] = None # None uses 3 (floating point) for floats and 2 (differencing) for integers
+    block_size: int = BLOCK_SIZE # 0 writes stripes instead of tiles
+    overviews: bool = False
+
+
+DEFAULT_ENCODING = RasterEncoding()
+
+
+def storage_dtype(dtype, encoding: RasterEncoding = DEFAULT_ENCODING) -> np.dtype:
+    return np.dtype(encoding.dtype if encoding.dtype is not None else dtype)
+
+
+def encoding_profile(dtype, encoding: RasterEncoding = DEFAULT_ENCODING) -> dict:
+    """Creation options of a GeoTIFF storing data of the dtype with the encoding."""
+    dtype = storage_dtype(dtype, encoding)
+    profile = dict(
+        driver='GTiff',
+        dtype=dtype.name,
+        nodata=encoding.nodata,
+        compress=encoding.compress,
+        predictor=encoding.predictor or (3 if np.issubdtype(dtype, np.floating) else 2),
+        BIGTIFF='IF_SAFER',
+    )
+    if encoding.level is not None:
+        assert encoding.compress in LEVEL_OPTIONS, f'{encoding.compress} does not support compression levels'
+        profile[LEVEL_OPTIONS[encoding.compress]] = encoding.level
+    if encoding.block_size > 0:
+        profile.update(tiled=True, blockxsize=encoding.block_size, blockysize=encoding.block_size)
+    else:
+        profile.update(tiled=False)
+    return profile
+
+
+def encode(data: np.ndarray, encoding: RasterEncoding = DEFAULT_ENCODING) -> np.ndarray:
+    """Converts data to the dtype of the encoding, dividing by its scale and replacing NaN by nodata.
+
+    The scale is written to every GeoTIFF with the encoding, so data is divided by it whatever the dtypes are;
+    `decode` multiplies by it again. Values equal to nodata are kept unscaled, as `decode` keeps them too.
+    """
+    dtype = storage_dtype(data.dtype, encoding)
+    if encoding.scale != 1:
+        missing = np.isnan(data) if np.issubdtype(data.dtype, np.floating) else np.zeros(data.shape, dtype=bool)
+        if encoding.nodata is not None:
+            missing |= (data == encoding.nodata)
+        data = np.where(missing, np.nan, data / np.float64(encoding.scale))
+    if np.issubdtype(dtype, np.integer) and np.issubdtype(data.dtype, np.floating):
+        info = np.iinfo(dtype)
+        scaled = np.clip(np.round(data), info.min, info.max)
+        missing = np.isnan(scaled)
+        if missing.any():
+            assert encoding.nodata is not None, 'Storing NaN as integers requires nodata'
+            scaled[missing] = encoding.nodata
+        return scaled.astype(dtype)
+    data = data.astype(dtype, copy=False)
+    if encoding.nodata is not None and np.issubdtype(dtype, np.floating):
+        data = np.where(np.isnan(data), dtype.type(encoding.nodata), data)
+    return data
+
+
+def decode(data: np.ndarray, dataset: rasterio.io.DatasetReader) -> np.ndarray:
+    """Unscales data read from a dataset with a scale other than 1, keeping nodata values unchanged."""
+    scale = dataset.scales[0]
+    if scale == 1:
+        return data
+    decoded = data * np.float64(scale)
+    if dataset.nodata is not None:
+        decoded[data == dataset.nodata] = dataset.nodata
+    return decoded
+
+
+def tif_writer(full_path: str, height: int, width: int, dtype, transform: Affine, crs: rasterio.crs.CRS,
+               encoding: RasterEncoding = DEFAULT_ENCODING) -> rasterio.io.DatasetWriter:
+    # https://rasterio.readthedocs.io/en/latest/quickstart.html#opening-a-dataset-in-writing-mode
+    profiling.output(full_path)
+    dataset = rasterio.open(
         full_path,
         'w',
-        driver='GTiff',
         height=height,
         width=width,
         count=1,
-        dtype=dtype,
         crs=crs,
-        compress='lzw',
         transform=transform,
-    ) as dst:
-        dst.write(data, 1)
+        **encoding_profile(dtype, encoding)
+    )
+    if encoding.scale != 1:
+        dataset.scales = (encoding.scale, )
+    return dataset
+
+
+def build_overviews(dataset: rasterio.io.DatasetWriter, encoding: RasterEncoding = DEFAULT_ENCODING):
+    """Adds overviews to a dataset after all data has been written, if the encoding asks for them."""
+    if encoding.overviews:
+        dataset.build_overviews(OVERVIEW_LEVELS, rasterio.enums.Resampling.average)
+
+
+def write_tif(full_path: str, data: np.ndarray, transform: Affine, crs: rasterio.crs.CRS,
+              encoding: RasterEncoding = DEFAULT_ENCODING):
+    data = encode(data, encoding)
+    height, width = data.shape
+    dtype = data.dtype
+    with profiling.phase("write"):
+        with tif_writer(full_path, height=height, width=width, dtype=dtype, transform=transform, crs=crs,
+                        encoding=encoding) as dst:
+            dst.write(data, 1)
+            build_overviews(dst, encoding)
+    profiling.bytes_written(full_path, data.nbytes)
+
+
+def convert_to_cog(path_to_tiled_tif: str, full_path: str, encoding: RasterEncoding = DEFAULT_ENCODING):
+    """Adds overviews to a tiled GeoTIFF and copies it to a Cloud-Optimized GeoTIFF with internal overviews."""
+    profiling.output(full_path)
+    with profiling.phase("write"):
+        with rasterio.open(path_to_tiled_tif, 'r+') as dataset:
+            if encoding.scale != 1:
+                dataset.scales = (encoding.scale, )
+            if encoding.nodata is not None:
+                dataset.nodata = encoding.nodata
+            dataset.build_overviews(OVERVIEW_LEVELS, rasterio.enums.Resampling.average)
+            profile = encoding_profile(dataset.dtypes[0], encoding)
+        for option in ('driver', 'dtype', 'nodata'):
+            profile.pop(option)
+        rasterio.shutil.copy(path_to_tiled_tif, full_path, driver='GTiff', copy_src_overviews=True, **profile)
+    profiling.bytes_written(full_path, os.path.getsize(full_path))
+
+
+def add_encoding_arguments(parser: argparse.ArgumentParser, defaults: RasterEncoding = DEFAULT_ENCODING):
+    """Adds options of the raster encoding to the command line interface of a script."""
+    group = parser.add_argument_group("raster encoding")
+    group.add_argument("--dtype", type=str, default=defaults.dtype)
+    group.add_argument("--scale", type=float, default=defaults.scale)
+    group.add_argument("--nodata", type=float, default=defaults.nodata)
+    group.add_argument("--compress", type=str, default=defaults.compress, choices=["deflate", "zstd", "lzw"])
+    group.add_argument("--level", type=int, default=defaults.level)
+    group.add_argument("--predictor", type=int, default=defaults.predictor, choices=[1, 2, 3])
+    group.add_argument("--block_size", type=int, default=defaults.block_size)
+    group.add_argument("--overviews", action="store_true", default=defaults.overviews)
+
+
+def pop_encoding(args: dict) -> RasterEncoding:
+    """Removes the options added by `add_encoding_arguments` from parsed arguments and returns the encoding."""
+    return RasterEncoding(**{field: args.pop(field) for field in RasterEncoding._fields})
 
 
 if __name__ == '__main__':
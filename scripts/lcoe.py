@@ -1,37 +1,211 @@
 """Uses information about capacity factors and costs for calculate engineering costs"""
 
 import argparse
+import itertools
+import os
+import sys
+import tempfile
+import threading
+from typing import List
 
+import dask
+import numcodecs
+import numpy as np
+import xarray as xr
 import rioxarray
 
+import profiling
+from file_management import convert_to_cog, encode, encoding_profile, storage_dtype
+from file_management import add_encoding_arguments, pop_encoding, RasterEncoding, DEFAULT_ENCODING
+
 HOURS_PER_YEAR = 8760
+ZARR_CODECS = {"deflate": numcodecs.Zlib, "zstd": numcodecs.Zstd}
 
 
 def _present_value_of_annuity_factor(discount_rate, lifetime):
-    nominator = ((1 + discount_rate) ** lifetime) * discount_rate
-    denominator = ((1 + discount_rate) ** lifetime) - 1
-    if discount_rate == 0:
-        return 1 / lifetime
-    else:
-        return nominator / denominator
+    # works for scalars and for arrays of discount rates and lifetimes alike
+    discount_rate = np.asarray(discount_rate, dtype=np.float64)
+    lifetime = np.asarray(lifetime, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        nominator = ((1 + discount_rate) ** lifetime) * discount_rate
+        denominator = ((1 + discount_rate) ** lifetime) - 1
+        return np.where(discount_rate == 0, 1 / lifetime, nominator / denominator)[()]
 
 
 def calculate_lcoe(investment_costs, annual_maintenance_costs, path_to_capacity_factors,
-                   discount_rate, lifetime, availability, path_to_output_lcoe, path_to_output_energy):
+                   discount_rate, lifetime, availability, path_to_output_lcoe, path_to_output_energy,
+                   chunk_size=2048, encoding: RasterEncoding = DEFAULT_ENCODING):
     assert 0 <= discount_rate <= 1
     assert 0 <= availability <= 1
-    capacity_factors = rioxarray.open_rasterio(path_to_capacity_factors)
+    # lazily computed in chunks; only a few chunks are held in memory at any time
+    capacity_factors = rioxarray.open_rasterio(
+        path_to_capacity_factors, mask_and_scale=True, chunks={"x": chunk_size, "y": chunk_size}
+    )
 
     annuity_factor = _present_value_of_annuity_factor(discount_rate, lifetime)
 
     annual_costs = investment_costs * annuity_factor + annual_maintenance_costs
     annual_energy = capacity_factors * HOURS_PER_YEAR * availability
     lcoe = annual_costs / annual_energy
-    lcoe.rio.to_raster(path_to_output_lcoe, compress="lzw")
-    annual_energy.rio.to_raster(path_to_output_energy)
+    write_cogs([lcoe, annual_energy], [path_to_output_lcoe, path_to_output_energy], encoding=encoding)
+
+
+def write_cogs(data_arrays: List[xr.DataArray], paths: List[str], encoding: RasterEncoding = DEFAULT_ENCODING):
+    """Computes all (dask-backed) data arrays in one pass and writes them as Cloud-Optimized GeoTIFFs."""
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(paths[0]))) as tmpdir:
+        paths_to_tiled = [os.path.join(tmpdir, os.path.basename(path)) for path in paths]
+        lock = threading.Lock()
+        dask.compute(*[
+            _encoded(data_array, encoding).rio.to_raster(
+                path_to_tiled, lock=lock, compute=False, **_to_raster_profile(data_array.dtype, encoding)
+            )
+            for data_array, path_to_tiled in zip(data_arrays, paths_to_tiled)
+        ])
+        for data_array, path_to_tiled, path in zip(data_arrays, paths_to_tiled, paths):
+            convert_to_cog(path_to_tiled, path, encoding=_with_nodata(data_array.dtype, encoding))
+
+
+def _with_nodata(dtype, encoding: RasterEncoding) -> RasterEncoding:
+    """Marks NaN as nodata of floating point rasters that have no explicit nodata, so that readers mask it."""
+    if encoding.nodata is None and np.issubdtype(storage_dtype(dtype, encoding), np.floating):
+        return encoding._replace(nodata=np.nan)
+    return encoding
+
+
+def _encoded(data_array: xr.DataArray, encoding: RasterEncoding) -> xr.DataArray:
+    return xr.apply_ufunc(
+        encode, data_array,
+        kwargs={"encoding": encoding},
+        dask="parallelized",
+        output_dtypes=[storage_dtype(data_array.dtype, encoding)],
+        keep_attrs=True,
+    )
+
+
+def _to_raster_profile(dtype, encoding: RasterEncoding) -> dict:
+    profile = encoding_profile(dtype, encoding)
+    profile.pop("nodata") # rioxarray ignores it; convert_to_cog sets nodata instead
+    return profile
+
+
+def _zarr_encoding(dtype, chunk_size: int, encoding: RasterEncoding) -> dict:
+    """Zarr encoding of a scenario x y x x variable, following the raster encoding where Zarr supports it.
+
+    Zarr has no predictors; deflate and zstd map to their numcodecs counterparts.
+    """
+    assert encoding.compress in ZARR_CODECS, f'{encoding.compress} is not supported for Zarr'
+    dtype = storage_dtype(dtype, encoding)
+    codec = ZARR_CODECS[encoding.compress]
+    zarr_encoding = {
+        "dtype": dtype,
+        "chunks": (1, chunk_size, chunk_size),
+        "compressor": codec() if encoding.level is None else codec(level=encoding.level),
+    }
+    if encoding.scale != 1:
+        zarr_encoding["scale_factor"] = encoding.scale
+    if encoding.nodata is not None:
+        zarr_encoding["_FillValue"] = encoding.nodata
+    return zarr_encoding
+
 
+def scenarios(investment_costs: List[float], annual_maintenance_costs: List[float], discount_rate: List[float],
+              lifetime: List[int], availability: List[float], grid: bool) -> xr.Dataset:
+    """Returns the parameters of all scenarios as variables along the `scenario` dimension.
 
-if __name__ == "__main__":
+    If grid, all combinations of the parameters form scenarios. Otherwise, the i-th values of all parameters
+    form the i-th scenario, and parameters with a single value apply to all scenarios.
+    """
+    parameters = {
+        "investment_costs": investment_costs,
+        "annual_maintenance_costs": annual_maintenance_costs,
+        "discount_rate": discount_rate,
+        "lifetime": lifetime,
+        "availability": availability,
+    }
+    if grid:
+        values = list(zip(*itertools.product(*parameters.values())))
+    else:
+        n_scenarios = max(len(value) for value in parameters.values())
+        assert all(len(value) in (1, n_scenarios) for value in parameters.values()), \
+            'all parameters must have either one value or one value per scenario'
+        values = [value * n_scenarios if len(value) == 1 else value for value in parameters.values()]
+    return xr.Dataset({
+        name: ("scenario", np.array(value))
+        for name, value in zip(parameters.keys(), values)
+    })
+
+
+def calculate_lcoe_sweep(path_to_capacity_factors, investment_costs, annual_maintenance_costs, discount_rate,
+                         lifetime, availability, grid, chunk_size, path_to_output,
+                         encoding: RasterEncoding = DEFAULT_ENCODING):
+    """Calculates LCOE for many scenarios at once and writes them lazily as a scenario x y x x Zarr cube.
+
+    The capacity factors are read once per chunk; all scenarios are derived from them by broadcasting.
+    LCOE is computed in float32 like the capacity factors and stored with the raster encoding.
+    """
+    parameters = scenarios(investment_costs, annual_maintenance_costs, discount_rate, lifetime, availability, grid)
+    assert ((0 <= parameters.discount_rate) & (parameters.discount_rate <= 1)).all()
+    assert ((0 <= parameters.availability) & (parameters.availability <= 1)).all()
+    capacity_factors = (
+        rioxarray
+        .open_rasterio(path_to_capacity_factors, mask_and_scale=True, chunks={"x": chunk_size, "y": chunk_size})
+        .squeeze("band", drop=True)
+    )
+
+    annuity_factor = xr.DataArray(
+        _present_value_of_annuity_factor(parameters.discount_rate.values, parameters.lifetime.values),
+        dims="scenario"
+    )
+    annual_costs = parameters.investment_costs * annuity_factor + parameters.annual_maintenance_costs
+    annual_energy = capacity_factors * HOURS_PER_YEAR * parameters.availability
+    lcoe = (
+        (annual_costs / annual_energy)
+        .astype(np.float32)
+        .transpose("scenario", "y", "x")
+        .chunk({"scenario": 1})
+        .rename("lcoe_eur_per_mwh")
+    )
+    lcoe.attrs = {}
+    profiling.output(path_to_output)
+    (
+        lcoe
+        .drop_vars("spatial_ref")
+        .assign_coords({name: parameters[name] for name in parameters.data_vars})
+        .to_dataset()
+        .assign_attrs(
+            transform=capacity_factors.rio.transform().to_gdal(),
+            crs=capacity_factors.rio.crs.to_wkt(),
+        )
+        .to_zarr(
+            path_to_output, mode="w", consolidated=True,
+            encoding={"lcoe_eur_per_mwh": _zarr_encoding(np.float32, chunk_size, encoding)}
+        )
+    )
+
+
+def _sweep_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="lcoe.py sweep")
+    parser.add_argument("path_to_capacity_factors", type=str)
+    parser.add_argument("--investment_costs", type=float, nargs="+")
+    parser.add_argument("--annual_maintenance_costs", type=float, nargs="+")
+    parser.add_argument("--discount_rate", type=float, nargs="+")
+    parser.add_argument("--lifetime", type=int, nargs="+")
+    parser.add_argument("--availability", type=float, nargs="+")
+    parser.add_argument("--grid", action="store_true")
+    parser.add_argument("--chunk_size", type=int, default=1024)
+    parser.add_argument("path_to_output", type=str)
+    add_encoding_arguments(parser)
+    return parser
+
+
+if __name__ == "__main__" and sys.argv[1:2] == ["sweep"]:
+    args = vars(_sweep_parser().parse_args(sys.argv[2:]))
+
+    calculate_lcoe_sweep(
+        encoding=pop_encoding(args),
+        **args
+    )
+elif __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("path_to_capacity_factors", type=str)
     parser.add_argument("investment_costs", type=float)
@@ -41,7 +215,11 @@ if __name__ == "__main__":
     parser.add_argument("availability", type=float)
     parser.add_argument("path_to_output_lcoe", type=str)
     parser.add_argument("path_to_output_energy", type=str)
+    parser.add_argument("--chunk_size", type=int, default=2048)
+    add_encoding_arguments(parser)
+    args = vars(parser.parse_args())
 
     calculate_lcoe(
-        **vars(parser.parse_args())
+        encoding=pop_encoding(args),
+        **args
     )
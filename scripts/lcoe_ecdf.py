@@ -1,32 +1,83 @@
 """Produces a figure representing the LCOE's cumulated distribution function"""
 
 import argparse
+import sys
+from typing import List
 
+import numpy as np
+import pandas as pd
 import matplotlib.pyplot as plt
-import seaborn as sns
-import rioxarray
+import rasterio
 
+import profiling
+from file_management import decode
 
-def visualise_lcoe_cdf(path_to_lcoe, path_to_plot):
-    ds = rioxarray.open_rasterio(path_to_lcoe)
-    data = ds.to_series().dropna().rename("lcoe").reset_index()
+BIN_WIDTH = 0.1 # €/MWh
+MAX_LCOE = 1000 # €/MWh; larger values are counted in the last, unbounded bin
+
+
+def lcoe_histogram(path_to_lcoe: str, path_to_output: str):
+    """Streams the raster block by block and counts LCOE in fixed bins.
+
+    The resulting histogram is small and can be combined with histograms of other rasters, countries, or
+    scenarios by summing counts.
+    """
+    edges = np.arange(0, MAX_LCOE + BIN_WIDTH / 2, BIN_WIDTH)
+    counts = np.zeros(len(edges) - 1, dtype=np.int64)
+    below, above = 0, 0
+    with rasterio.open(path_to_lcoe) as src:
+        index, = src.indexes
+        for _, window in src.block_windows(index):
+            values = decode(src.read(index, window=window, masked=True).compressed(), src)
+            values = values[np.isfinite(values)]
+            counts += np.histogram(values, bins=edges)[0]
+            below += (values < edges[0]).sum()
+            above += (values > edges[-1]).sum()
+    profiling.output(path_to_output)
+    pd.DataFrame({
+        "lcoe_from_eur_per_mwh": np.r_[-np.inf, edges[:-1], edges[-1]],
+        "lcoe_to_eur_per_mwh": np.r_[edges[0], edges[1:], np.inf],
+        "count": np.r_[below, counts, above],
+    }).to_csv(path_to_output, index=False)
+
+
+def combine_histograms(paths_to_histograms: List[str]) -> pd.DataFrame:
+    histograms = [pd.read_csv(path) for path in paths_to_histograms]
+    combined = histograms[0].copy()
+    for histogram in histograms[1:]:
+        assert (histogram["lcoe_to_eur_per_mwh"] == combined["lcoe_to_eur_per_mwh"]).all(), \
+            'Only histograms with identical bins can be combined'
+        combined["count"] += histogram["count"]
+    return combined
+
+
+def visualise_lcoe_cdf(paths_to_histograms: List[str], path_to_plot: str):
+    histogram = combine_histograms(paths_to_histograms)
+    ecdf = histogram["count"].cumsum() / histogram["count"].sum()
 
     fig = plt.figure(figsize=(8, 4))
     ax = fig.add_subplot(111)
-    sns.ecdfplot(
-        data=data,
-        x="lcoe",
-        ax=ax,
-        legend=False
-    )
+    ax.step(histogram["lcoe_to_eur_per_mwh"], ecdf, where="post")
     ax.set_xlim(0, 100)
+    ax.set_ylim(0, 1.05)
     ax.set_xlabel("LCOE (€/MWh)")
+    ax.set_ylabel("Proportion")
+    profiling.output(path_to_plot)
     fig.savefig(path_to_plot)
+    plt.close(fig)
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
+if __name__ == "__main__" and sys.argv[1:2] == ["histogram"]:
+    parser = argparse.ArgumentParser(prog="lcoe_ecdf.py histogram")
     parser.add_argument("path_to_lcoe", type=str)
+    parser.add_argument("path_to_output", type=str)
+
+    lcoe_histogram(
+        **vars(parser.parse_args(sys.argv[2:]))
+    )
+elif __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths_to_histograms", type=str, nargs="+")
     parser.add_argument("path_to_plot", type=str)
 
     visualise_lcoe_cdf(
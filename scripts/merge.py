@@ -1,104 +1,226 @@
 """Merges information specific to the individual (potential) turbine locations into a comprehensive output table"""
 
 import argparse
+import sys
 
 import pandas as pd
-import xarray as xr
 import numpy as np
 
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
-from file_management import tif_values
-from disamenity_cost import disamenity_costs
+from file_management import raster_sampler
+from tables import is_parquet, read_table, write_table, COORDINATE_COLUMNS, MW_PER_TURBINE
+from disamenity_cost import disamenity_costs, disamenity_at_points, MINIMAL_DISTANCE_IN_KM
 
 
 def get_locations(path_to_turbine_locations:str) -> List[Tuple]:
-    df = pd.read_csv(path_to_turbine_locations)
+    df = read_table(path_to_turbine_locations, columns=COORDINATE_COLUMNS)
     return list(zip(df['x_m'], df['y_m']))
 
 
-def merge(
-    distances: List[str],
-    path_to_turbine_locations: str,
+def turbine_costs(
+    distances: List[int],
+    xs: np.ndarray,
+    ys: np.ndarray,
     path_to_lcoe: str,
     path_to_annual_energy: str,
-    path_to_disamenity_cost: str,
-    paths_to_population_by_distance: List[str],
-    path_to_output: str
-):
-
-    locations = get_locations(path_to_turbine_locations)
-
-    # Decomposes list of tuples in arry of x coordinates and arry of y coordinates; alternative to zip(*locations)
-    xs, ys = np.array(locations).transpose()
+    path_to_disamenity_cost: Optional[str],
+    paths_to_population_by_distance: Optional[List[str]],
+    path_to_population: Optional[str] = None,
+    continuous: bool = False,
+    path_to_datacube: Optional[str] = None,
+) -> pd.DataFrame:
+    """Samples all rasters once at the turbine locations and derives their costs as whole-array operations.
+
+    If the path to the datacube is given, all layers are sampled from it in a single indexed read instead.
+    If the path to the population is given, population and disamenity cost are evaluated at the turbine
+    locations directly instead of being sampled from rasters of the entire area.
+    """
+    if path_to_datacube is not None:
+        lcoe, annual_energy, disamenity, *population_by_distance = _sample_datacube(
+            path_to_datacube, distances, xs, ys
+        )
+    else:
+        if path_to_population is None:
+            paths = [path_to_lcoe, path_to_annual_energy, path_to_disamenity_cost] + paths_to_population_by_distance
+        else:
+            paths = [path_to_lcoe, path_to_annual_energy]
+        with raster_sampler() as sampler:
+            lcoe, annual_energy, *disamenity_and_population = [
+                sampler.sample(path, xs, ys).filled(np.nan) for path in paths
+            ]
+        if path_to_population is None:
+            disamenity, *population_by_distance = disamenity_and_population
+    if path_to_population is None:
+        population_within_distances = np.stack(population_by_distance, axis=1)
+    else:
+        population_within_distances, disamenity = disamenity_at_points(
+            distances, path_to_population, xs, ys, continuous=continuous
+        )
 
     df = pd.DataFrame(
         index=pd.MultiIndex.from_arrays(
             arrays=[xs, ys],
             names=('x_m', 'y_m')))
 
-    df['lcoe_eur_per_mwh'] = tif_values(path_to_lcoe, coordinates=locations)
-    mw_per_turbine = 2
-    df['disamenity_cost'] = tif_values(path_to_disamenity_cost, coordinates=locations)
-    df['annual_energy'] = tif_values(path_to_annual_energy, coordinates=locations)
-    df['disamenity_cost_eur_per_mwh'] = [disamenity/(energy*mw_per_turbine) for disamenity, energy in zip(
-        tif_values(path_to_disamenity_cost, coordinates=locations),
-        tif_values(path_to_annual_energy, coordinates=locations),
-    )]
-
-    previous_distance = None
-    cumulated_population = 0
-    cumulated_cost = 0
-    for distance, path_to_population in zip(distances, paths_to_population_by_distance):
-
-        # Population in a counted between two distances
-        df[distance] = tif_values(path_to_population, coordinates=locations)
-        if previous_distance is not None:
-            df[distance] -= cumulated_population
-
-            # Disamenity cost (for QA)
-            df[f'cost_{distance}'] = df[distance] * disamenity_costs(previous_distance, distance)
-        else:
-            df[f'cost_{distance}'] = df[distance] * disamenity_costs(0.2, distance)
+    df['lcoe_eur_per_mwh'] = lcoe
+    df['disamenity_cost'] = disamenity
+    df['annual_energy'] = annual_energy
+    df['disamenity_cost_eur_per_mwh'] = disamenity / (annual_energy * MW_PER_TURBINE)
+
+    # Population in a counted between two distances
+    population_in_ring = np.diff(population_within_distances, axis=1, prepend=0)
+    cost_per_person = np.array([
+        disamenity_costs(radius_from, radius_to)
+        for radius_from, radius_to in zip([MINIMAL_DISTANCE_IN_KM] + list(distances[:-1]), distances)
+    ])
+    # Disamenity cost (for QA)
+    cost_in_ring = population_in_ring * cost_per_person
+    for i, distance in enumerate(distances):
+        df[distance] = population_in_ring[:, i]
+        df[f'cost_{distance}'] = cost_in_ring[:, i]
+    df['cumulated_cost'] = cost_in_ring.sum(axis=1)
+
+    return df.reset_index()
+
+
+def _sample_datacube(path_to_datacube: str, distances: List[int], xs: np.ndarray, ys: np.ndarray) -> List[np.ndarray]:
+    # Returns LCOE, annual energy, disamenity cost, and the population within all distances
+    from datacube import open_datacube, sample_datacube, population_layer # imports xarray only if necessary
+    from datacube import LCOE_LAYER, ANNUAL_ENERGY_LAYER, DISAMENITY_COST_LAYER
+
+    names = [LCOE_LAYER, ANNUAL_ENERGY_LAYER, DISAMENITY_COST_LAYER] + [population_layer(d) for d in distances]
+    samples = sample_datacube(open_datacube(path_to_datacube), xs, ys, names=names)
+    return [samples[name].to_numpy() for name in names]
+
+
+def merge(
+    distances: List[int],
+    path_to_turbine_locations: str,
+    path_to_lcoe: str,
+    path_to_annual_energy: str,
+    path_to_disamenity_cost: Optional[str],
+    paths_to_population_by_distance: Optional[List[str]],
+    path_to_output: str,
+    path_to_population: Optional[str] = None,
+    continuous: bool = False,
+    path_to_datacube: Optional[str] = None,
+):
 
-        cumulated_cost += df[f'cost_{distance}']
-        cumulated_population += df[distance]
-        previous_distance = distance
+    locations = get_locations(path_to_turbine_locations)
 
-    df['cumulated_cost'] = cumulated_cost
+    # Decomposes list of tuples in arry of x coordinates and arry of y coordinates; alternative to zip(*locations)
+    xs, ys = np.array(locations).transpose()
 
-    df.reset_index(inplace=True)
+    df = turbine_costs(
+        distances, xs, ys,
+        path_to_lcoe=path_to_lcoe,
+        path_to_annual_energy=path_to_annual_energy,
+        path_to_disamenity_cost=path_to_disamenity_cost,
+        paths_to_population_by_distance=paths_to_population_by_distance,
+        path_to_population=path_to_population,
+        continuous=continuous,
+        path_to_datacube=path_to_datacube,
+    )
 
-    df.to_csv(path_to_output)
+    write_table(df, path_to_output)
 
 
-def infer_map_coords(map: xr.DataArray, x: int, y: int, x_res: int, y_res: int):
-    """Returns map coordinates closest to input coordinates."""
-    x_proximity = map.x.loc[slice(x - x_res, x + x_res)]
-    y_proximity = map.y.loc[slice(y - y_res, y + y_res)]
-    try:
-        map_x = x_proximity.item()
-    except ValueError:
-        # handle case where x is equally far from two map points
-        assert x_proximity.count() == 2, f"Exactly 2 values expected in proximity of {x}. Check resolution: {x_proximity}"
-        map_x = x_proximity.values[0] # always take the smaller of the two
-    try:
-        map_y = y_proximity.item()
-    except ValueError:
-        # handle case where y is equally far from two map points
-        assert y_proximity.count() == 2, f"Exactly 2 values expected in proximity of {y}. Check resolution: {y_proximity}"
-        map_y = y_proximity.values[0] # always take the smaller of the two
-    return {"x": map_x, "y": map_y}
+def merge_all(
+    distances: List[int],
+    country_ids: List[str],
+    path_to_turbine_locations: str,
+    path_to_lcoe: str,
+    path_to_annual_energy: str,
+    path_to_disamenity_cost: Optional[str],
+    paths_to_population_by_distance: Optional[List[str]],
+    path_to_output: str,
+    path_to_population: Optional[str] = None,
+    continuous: bool = False,
+    path_to_datacube: Optional[str] = None,
+):
+    """Merges the turbines of all countries, sampling every raster only once.
+
+    The paths to turbine locations and to the output contain the placeholder `{country_id}`. Alternatively,
+    the output is a single Parquet table partitioned by `country_id`.
+    """
+    locations = pd.concat(
+        [
+            read_table(path_to_turbine_locations.format(country_id=country_id), columns=COORDINATE_COLUMNS)
+            for country_id in country_ids
+        ],
+        keys=country_ids,
+        names=['country_id', None]
+    )
 
+    df = turbine_costs(
+        distances,
+        xs=locations['x_m'].values,
+        ys=locations['y_m'].values,
+        path_to_lcoe=path_to_lcoe,
+        path_to_annual_energy=path_to_annual_energy,
+        path_to_disamenity_cost=path_to_disamenity_cost,
+        paths_to_population_by_distance=paths_to_population_by_distance,
+        path_to_population=path_to_population,
+        continuous=continuous,
+        path_to_datacube=path_to_datacube,
+    )
+    df.index = locations.index.get_level_values('country_id')
 
-def assert_same_coords(da1: xr.DataArray, da2: xr.DataArray):
-    assert da1.spatial_ref.crs_wkt == da2.spatial_ref.crs_wkt
-    assert len(da1.x) == len(da2.x)
-    assert len(da2.y) == len(da2.y)
-    assert da1.spatial_ref.GeoTransform == da2.spatial_ref.GeoTransform
+    if "{country_id}" not in path_to_output:
+        assert is_parquet(path_to_output), 'Only Parquet tables can contain all countries'
+        write_table(df.reset_index(), path_to_output, partition_cols=['country_id'])
+        return
+    for country_id in country_ids:
+        write_table(
+            df.loc[[country_id]].reset_index(drop=True),
+            path_to_output.format(country_id=country_id)
+        )
 
 
-if __name__ == "__main__":
+if __name__ == "__main__" and sys.argv[1:2] == ["datacube"]:
+    parser = argparse.ArgumentParser(prog="merge.py datacube")
+    parser.add_argument("path_to_turbine_locations", type=str)
+    parser.add_argument("path_to_datacube", type=str)
+    parser.add_argument("path_to_output", type=str)
+    parser.add_argument("--distances", type=int, nargs="*")
+    parser.add_argument("--country_ids", type=str, nargs="*")
+    args = vars(parser.parse_args(sys.argv[2:]))
+    args.update(path_to_lcoe=None, path_to_annual_energy=None, path_to_disamenity_cost=None,
+                paths_to_population_by_distance=None)
+
+    if args["country_ids"]: # all countries in one run
+        merge_all(
+            **args
+        )
+    else:
+        args.pop("country_ids")
+        merge(
+            **args
+        )
+elif __name__ == "__main__" and sys.argv[1:2] == ["points"]:
+    parser = argparse.ArgumentParser(prog="merge.py points")
+    parser.add_argument("path_to_turbine_locations", type=str)
+    parser.add_argument("path_to_lcoe", type=str)
+    parser.add_argument("path_to_annual_energy", type=str)
+    parser.add_argument("path_to_population", type=str)
+    parser.add_argument("path_to_output", type=str)
+    parser.add_argument("--distances", type=int, nargs="*")
+    parser.add_argument("--continuous", action="store_true")
+    parser.add_argument("--country_ids", type=str, nargs="*")
+    args = vars(parser.parse_args(sys.argv[2:]))
+    args.update(path_to_disamenity_cost=None, paths_to_population_by_distance=None)
+
+    if args["country_ids"]: # all countries in one run
+        merge_all(
+            **args
+        )
+    else:
+        args.pop("country_ids")
+        merge(
+            **args
+        )
+elif __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("path_to_turbine_locations", type=str)
     parser.add_argument("path_to_lcoe", type=str)
@@ -106,8 +228,16 @@ if __name__ == "__main__":
     parser.add_argument("path_to_disamenity_cost", type=str)
     parser.add_argument("paths_to_population_by_distance", type=str, nargs="*")
     parser.add_argument("--distances", type=int, nargs="*")
+    parser.add_argument("--country_ids", type=str, nargs="*")
     parser.add_argument("path_to_output", type=str)
-
-    merge(
-        **vars(parser.parse_args())
-    )
+    args = vars(parser.parse_args())
+
+    if args["country_ids"]: # all countries in one run
+        merge_all(
+            **args
+        )
+    else:
+        args.pop("country_ids")
+        merge(
+            **args
+        )
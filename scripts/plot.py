@@ -1,24 +1,74 @@
 """Produces cost potential curve figures based on engineering costs with as well as without disamenity costs"""
 
 import argparse
+import os
+import sys
+from typing import Tuple
 
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 
+import profiling
+from tables import read_table, MW_PER_TURBINE
 
-def plot(path_to_turbines: str, path_to_output: str):
+CURVES = {
+    "engineering": "Engineering cost",
+    "total": "Engineering cost\n+disamenity cost"
+}
+TOLERANCE = 0.1 # EUR/MWh; maximum deviation of the downsampled curve
 
-    capacity = 2
-    turbines = pd.read_csv(path_to_turbines, index_col=0)
 
+def sorted_curve(costs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns cumulative capacity in GW and the ascending costs of all turbines with known costs."""
+    costs = np.sort(costs[np.isfinite(costs)])
+    cumulative_capacity = np.arange(len(costs)) * MW_PER_TURBINE / 1000
+    return cumulative_capacity, costs
 
-    cumulative_capacity = [x * capacity / 1000 for x in range(len(turbines))]
-    engineering_cost = turbines['lcoe_eur_per_mwh'].sort_values()
-    disamenity_cost = (turbines['lcoe_eur_per_mwh'] + turbines['disamenity_cost_eur_per_mwh']).sort_values()
-    
-    plt.figure()
-    plt.plot(cumulative_capacity, engineering_cost, label='Engineering cost')
-    plt.plot(cumulative_capacity, disamenity_cost, label='Engineering cost\n+disamenity cost')
+
+def downsample(cumulative_capacity: np.ndarray, costs: np.ndarray, tolerance: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Reduces a sorted curve to the first and last point of every cost band of width `tolerance`.
+
+    Costs are monotonic, hence linear interpolation between the remaining points deviates by less than
+    `tolerance` from the full curve.
+    """
+    if len(costs) == 0:
+        return cumulative_capacity, costs
+    band = np.floor(costs / tolerance)
+    changes = np.flatnonzero(np.diff(band)) + 1
+    keep = np.unique(np.r_[0, changes - 1, changes, len(costs) - 1])
+    return cumulative_capacity[keep], costs[keep]
+
+
+def curve_table(cumulative_capacity: np.ndarray, costs: np.ndarray, curve: str) -> pd.DataFrame:
+    return pd.DataFrame({
+        "curve": curve,
+        "cumulative_capacity_gw": cumulative_capacity,
+        "lcoe_eur_per_mwh": costs
+    })
+
+
+def cost_potential_curve(path_to_turbines: str, path_to_output: str, tolerance: float = TOLERANCE):
+    turbines = read_table(path_to_turbines, columns=['lcoe_eur_per_mwh', 'disamenity_cost_eur_per_mwh'])
+    costs = {
+        "engineering": turbines['lcoe_eur_per_mwh'].to_numpy(),
+        "total": (turbines['lcoe_eur_per_mwh'] + turbines['disamenity_cost_eur_per_mwh']).to_numpy()
+    }
+    profiling.output(path_to_output)
+    pd.concat([
+        curve_table(*downsample(*sorted_curve(costs[curve]), tolerance), curve)
+        for curve in CURVES
+    ]).to_csv(path_to_output, index=False)
+
+
+def plot(path_to_curve: str, path_to_output: str):
+    import matplotlib.pyplot as plt # imported here as other scripts only need the curve helpers
+
+    curves = pd.read_csv(path_to_curve)
+
+    fig = plt.figure()
+    for curve, label in CURVES.items():
+        points = curves[curves["curve"] == curve]
+        plt.plot(points['cumulative_capacity_gw'], points['lcoe_eur_per_mwh'], label=label)
 
     plt.xlabel('Cumulative capacity (GW)')
     plt.ylabel('Levelized cost of electricity (EUR/MWh)')
@@ -26,13 +76,26 @@ def plot(path_to_turbines: str, path_to_output: str):
 
     plt.legend()
 
-    plt.savefig(path_to_output)
+    profiling.output(path_to_output)
+    with profiling.phase("write"):
+        plt.savefig(path_to_output)
+    profiling.bytes_written(path_to_output, os.path.getsize(path_to_output))
+    plt.close(fig) # several plots may run in one process, e.g. in a batch
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
+if __name__ == "__main__" and sys.argv[1:2] == ["curve"]:
+    parser = argparse.ArgumentParser(prog="plot.py curve")
     parser.add_argument("path_to_turbines", type=str)
     parser.add_argument("path_to_output", type=str)
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+
+    cost_potential_curve(
+        **vars(parser.parse_args(sys.argv[2:]))
+    )
+elif __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path_to_curve", type=str)
+    parser.add_argument("path_to_output", type=str)
 
     plot(
         **vars(parser.parse_args())
@@ -1,38 +1,52 @@
 """Counts counts for each cell the population within a given radius and stores the information in a raster file"""
 
 import argparse
+import os
+import tempfile
 
-import math
 import numpy as np
 import pandas as pd
 
 from scipy import signal
 from functools import lru_cache
+from typing import List, Optional
 
 from file_management import write_tif, tif_crs, tif_data, tif_transform
+from file_management import add_encoding_arguments, pop_encoding, RasterEncoding, DEFAULT_ENCODING
+from tiling import convolve_tiled
 
 
-def within_radius_mask(radius: float) -> np.ndarray:
+QUADRATURE_POINTS = 10000 # number of integration points per kernel cell
+
+
+def _triangular_cdf(v: np.ndarray) -> np.ndarray:
+    """CDF of the difference of two uniformly distributed variables on [-0.5, 0.5]."""
+    v = np.clip(v, -1, 1)
+    return np.where(v < 0, (v + 1) ** 2 / 2, 1 - (1 - v) ** 2 / 2)
+
+
+def within_radius_mask(radius: float, decimals: Optional[int] = 2) -> np.ndarray:
 
     @lru_cache(maxsize=128)
-    def within_radius(a, b, draws=1000000):
+    def within_radius(a, b, points=QUADRATURE_POINTS):
         '''
         This function returns the probability that the distance between a random point in the raster 0, 0 and a random
         point in the raster a, b is smaller than a given radius r.
         The units of a, b, and r are the resolution of the population raster (currently 1 km)
+
+        The offset between both points is (a + u, b + v) where u and v follow a triangular distribution on [-1, 1].
+        The inner integral over v has a closed form; the outer integral over u is solved with the midpoint rule,
+        which makes the result deterministic.
         :param r: cutoff radius
         :param a: distance of the rasters in one direction
         :param b: distnace of the rasters in the other direction
         :return: probability
         '''
-        count = 0
-        for _ in range(draws):
-            x0, y0 = -0.5 + np.random.random(), -0.5 + np.random.random()
-            x1, y1 = a - 0.5 + np.random.random(), b - 0.5 + np.random.random()
-            distance = math.sqrt((x1-x0)**2 + (y1-y0)**2)
-            if distance < radius:
-                count += 1
-        return count/draws
+        u = -1 + (np.arange(points) + 0.5) * 2 / points
+        weight = (1 - np.abs(u)) * 2 / points
+        half_chord = np.sqrt(np.clip(radius ** 2 - (a + u) ** 2, 0, None))
+        probability = _triangular_cdf(-b + half_chord) - _triangular_cdf(-b - half_chord)
+        return float((weight * probability).sum())
 
     ceil = int(np.ceil(radius))
     rng = range(-ceil, ceil+1)
@@ -42,14 +56,48 @@ def within_radius_mask(radius: float) -> np.ndarray:
             a, b = sorted([abs(x), abs(y)])
             df.loc[x, y] = within_radius(a, b)
 
-    return df.round(2).values
+    return df.values if decimals is None else df.round(decimals).values
+
 
+def cached_within_radius_mask(radius: float, resolution: float, path_to_cache: Optional[str],
+                              decimals: Optional[int] = 2) -> np.ndarray:
+    """Returns the mask for a radius given in units of a raster with given resolution (both in km).
 
-def generate_population_in_radius(source_path: str, destination_path: str, distance: int):
+    Masks are stored in and reused from `path_to_cache`, if given.
+    """
+    if path_to_cache is None:
+        return within_radius_mask(radius=radius / resolution, decimals=decimals)
+    # all parameters of the mask are part of the name, so that masks of other settings are never reused
+    path_to_mask = os.path.join(
+        path_to_cache,
+        f"within-{radius:g}km-at-{resolution:g}km-resolution-{QUADRATURE_POINTS}-points-{decimals}-decimals.npy"
+    )
+    if os.path.isfile(path_to_mask):
+        return np.load(path_to_mask)
+    mask = within_radius_mask(radius=radius / resolution, decimals=decimals)
+    os.makedirs(path_to_cache, exist_ok=True)
+    # write to a temporary file first, as several jobs may populate the cache at the same time
+    with tempfile.NamedTemporaryFile(dir=path_to_cache, suffix=".npy", delete=False) as f:
+        np.save(f, mask)
+    os.replace(f.name, path_to_mask)
+    return mask
+
+
+def generate_population_in_radius(source_path: str, destination_path: str, distance: int,
+                                  kernel_cache: Optional[str] = None, tile_size: int = 0, workers: int = 1,
+                                  encoding: RasterEncoding = DEFAULT_ENCODING):
+    transform = tif_transform(source_path)
+    resolution_in_km = abs(transform.a) / 1000 # EPSG3035's unit is meters
+    kernel = cached_within_radius_mask(radius=distance, resolution=resolution_in_km, path_to_cache=kernel_cache)
+
+    if tile_size > 0: # out-of-core
+        convolve_tiled(source_path, destination_path, kernel=kernel, tile_size=tile_size, workers=workers,
+                       encoding=encoding)
+        return
 
     data = signal.convolve2d(
         tif_data(source_path, replace_nodata=0),
-        within_radius_mask(radius=distance),
+        kernel,
         boundary='wrap',
         mode='same',
     )
@@ -58,18 +106,95 @@ def generate_population_in_radius(source_path: str, destination_path: str, dista
     write_tif(
         full_path=destination_path,
         data = data,
-        transform = tif_transform(source_path),
+        transform = transform,
         crs = tif_crs(source_path),
+        encoding = encoding,
     )
 
 
+def convolve_wrap_fft(data_fft: np.ndarray, shape: tuple, kernel: np.ndarray) -> np.ndarray:
+    """Convolves with the kernel given the real FFT of the data.
+
+    The result equals `signal.convolve2d(data, kernel, boundary='wrap', mode='same')` for kernels with odd shape,
+    because a product in the frequency domain is a circular convolution.
+    """
+    kernel_rows, kernel_cols = kernel.shape
+    padded_kernel = np.zeros(shape, dtype=np.float64)
+    padded_kernel[:kernel_rows, :kernel_cols] = kernel
+    padded_kernel = np.roll(padded_kernel, shift=(-(kernel_rows // 2), -(kernel_cols // 2)), axis=(0, 1))
+    data = np.fft.irfft2(data_fft * np.fft.rfft2(padded_kernel), s=shape)
+    return np.clip(data, 0, None) # remove negative round-off errors; population counts cannot be negative
+
+
+def generate_population_in_radii(source_path: str, destination_paths: List[str], distances: List[int],
+                                 kernel_cache: Optional[str] = None, tile_size: int = 0, workers: int = 1,
+                                 encoding: RasterEncoding = DEFAULT_ENCODING):
+    """Generates the population within all distances from a single read and FFT of the population raster.
+
+    With a positive tile_size, rasters are instead convolved out-of-core, tile by tile.
+    """
+    assert len(distances) == len(destination_paths), \
+        f'distances (len = {len(distances)}) and destination_paths {len(destination_paths)} have different length'
+    if tile_size > 0:
+        for distance, destination_path in zip(distances, destination_paths):
+            generate_population_in_radius(source_path, destination_path, distance, kernel_cache=kernel_cache,
+                                          tile_size=tile_size, workers=workers, encoding=encoding)
+        return
+    transform = tif_transform(source_path)
+    crs = tif_crs(source_path)
+    resolution_in_km = abs(transform.a) / 1000 # EPSG3035's unit is meters
+
+    population = tif_data(source_path, replace_nodata=0)
+    shape = population.shape
+    population_fft = np.fft.rfft2(population.astype(np.float64))
+    del population
+
+    for distance, destination_path in zip(distances, destination_paths):
+        write_tif(
+            full_path=destination_path,
+            data=convolve_wrap_fft(
+                population_fft,
+                shape=shape,
+                kernel=cached_within_radius_mask(radius=distance, resolution=resolution_in_km,
+                                                 path_to_cache=kernel_cache),
+            ),
+            transform=transform,
+            crs=crs,
+            encoding=encoding,
+        )
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("source_path", type=str)
-    parser.add_argument("distance", type=int)
-    parser.add_argument("destination_path", type=str)
-
-    generate_population_in_radius(
-        **vars(parser.parse_args())
-    )
-
+    parser.add_argument("distance", type=int, nargs="?")
+    parser.add_argument("destination_path", type=str, nargs="?")
+    parser.add_argument("--distances", type=int, nargs="*")
+    parser.add_argument("--destination_paths", type=str, nargs="*")
+    parser.add_argument("--kernel_cache", type=str, default=None)
+    parser.add_argument("--tile_size", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=1)
+    add_encoding_arguments(parser)
+    args = parser.parse_args()
+    encoding = pop_encoding(vars(args))
+
+    if args.distances: # all distances in one pass
+        generate_population_in_radii(
+            source_path=args.source_path,
+            destination_paths=args.destination_paths,
+            distances=args.distances,
+            kernel_cache=args.kernel_cache,
+            tile_size=args.tile_size,
+            workers=args.workers,
+            encoding=encoding,
+        )
+    else:
+        generate_population_in_radius(
+            source_path=args.source_path,
+            destination_path=args.destination_path,
+            distance=args.distance,
+            kernel_cache=args.kernel_cache,
+            tile_size=args.tile_size,
+            workers=args.workers,
+            encoding=encoding,
+        )
@@ -0,0 +1,194 @@
+"""Records wall time, CPU time, peak memory, raster I/O, and read/compute/write timings of script runs
+
+Profiling is enabled by setting the environment variable WIND_ONSHORE_PROFILE. On exit, the profile of the run is
+written as JSON next to every output the run registered, named `<output>.profile.json`.
+"""
+
+import argparse
+import atexit
+import contextlib
+import glob
+import json
+import os
+import re
+import resource
+import sys
+import time
+import uuid
+from collections import defaultdict
+from typing import List, Optional
+
+ENVIRONMENT_VARIABLE = "WIND_ONSHORE_PROFILE"
+PROFILE_SUFFIX = ".profile.json"
+
+
+class Profile:
+    """Profile of a single run of a script."""
+
+    def __init__(self):
+        self.run = uuid.uuid4().hex
+        self.script = os.path.basename(sys.argv[0])
+        self.arguments = sys.argv[1:]
+        self.outputs: List[str] = []
+        self.phases = defaultdict(float)
+        self.worker_phases = defaultdict(float)
+        self.rasters = defaultdict(lambda: {"bytes_read": 0, "bytes_written": 0})
+        self._active_phase: Optional[str] = None
+        self._start_wall = time.perf_counter()
+        self._start_cpu = time.process_time()
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        if self._active_phase is not None: # nested phases are attributed to the outermost phase
+            yield
+            return
+        self._active_phase = name
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.perf_counter() - start
+            self._active_phase = None
+
+    def summary(self) -> dict:
+        wall = time.perf_counter() - self._start_wall
+        # ru_maxrss is in kB on Linux; children are worker processes, e.g. of tiled processing
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        peak_rss_children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+        phases = dict(self.phases)
+        phases["compute"] = wall - sum(phases.values())
+        # phases of worker processes overlap with the wall time of this process and are added afterwards
+        for name, seconds in self.worker_phases.items():
+            phases[name] = phases.get(name, 0) + seconds
+        return {
+            "run": self.run,
+            "script": self.script,
+            "arguments": self.arguments,
+            "outputs": self.outputs,
+            "wall_s": wall,
+            "cpu_s": time.process_time() - self._start_cpu,
+            "peak_rss_mb": peak_rss,
+            "peak_rss_children_mb": peak_rss_children,
+            "phases_s": phases,
+            "rasters": dict(self.rasters),
+        }
+
+    def write(self):
+        summary = self.summary()
+        for output in self.outputs:
+            if os.path.exists(output):
+                with open(output.rstrip("/") + PROFILE_SUFFIX, "w") as f:
+                    json.dump(summary, f, indent=2)
+
+
+_profile = Profile() if os.environ.get(ENVIRONMENT_VARIABLE) else None
+
+
+def _write():
+    if _profile is not None:
+        _profile.write()
+
+
+atexit.register(_write)
+
+
+def restart():
+    """Writes the profile of the current run and starts a new one, e.g. for the next step of a batch."""
+    global _profile
+    if _profile is not None:
+        _profile.write()
+        _profile = Profile()
+
+
+def phase(name: str):
+    """Context manager attributing the time spent within to a phase, e.g. read or write."""
+    if _profile is None:
+        return contextlib.nullcontext()
+    return _profile.phase(name)
+
+
+def add_phase(name: str, seconds: float, worker: bool = False):
+    """Attributes time measured elsewhere to a phase, e.g. time spent reading in a worker process."""
+    if _profile is not None:
+        (_profile.worker_phases if worker else _profile.phases)[name] += seconds
+
+
+def bytes_read(path: str, nbytes: int):
+    if _profile is not None:
+        _profile.rasters[str(path)]["bytes_read"] += int(nbytes)
+
+
+def bytes_written(path: str, nbytes: int):
+    if _profile is not None:
+        _profile.rasters[str(path)]["bytes_written"] += int(nbytes)
+
+
+def output(path: str):
+    """Registers an output of the run; its profile will be written next to it."""
+    if _profile is not None and str(path) not in _profile.outputs:
+        _profile.outputs.append(str(path))
+
+
+def _country_id(profile: dict, country_ids: List[str]) -> str:
+    # "all" if the run created outputs of several countries, empty if of none
+    found = {
+        country_id
+        for output in profile["outputs"]
+        for country_id in country_ids
+        if re.search(rf"(?<![A-Za-z]){country_id}(?![A-Za-z])", os.path.basename(output.rstrip("/")))
+    }
+    if len(found) > 1:
+        return "all"
+    return found.pop() if found else ""
+
+
+def profile_report(path_to_build: str, country_ids: List[str], path_to_output: str):
+    """Aggregates all profiles into wall time, memory, and I/O per script and country, slowest first."""
+    import pandas as pd # imported here as every script imports this module but only the report needs pandas
+
+    profiles = {}
+    for path in glob.glob(os.path.join(path_to_build, "**", "*" + PROFILE_SUFFIX), recursive=True):
+        with open(path, "r") as f:
+            profile = json.load(f)
+        profiles[profile["run"]] = profile # several outputs of the same run share one profile
+
+    report = pd.DataFrame([
+        {
+            "script": profile["script"],
+            "country_id": _country_id(profile, country_ids),
+            "wall_s": profile["wall_s"],
+            "cpu_s": profile["cpu_s"],
+            "read_s": profile["phases_s"].get("read", 0),
+            "compute_s": profile["phases_s"].get("compute", 0),
+            "write_s": profile["phases_s"].get("write", 0),
+            "peak_rss_mb": max(profile["peak_rss_mb"], profile["peak_rss_children_mb"]),
+            "bytes_read": sum(raster["bytes_read"] for raster in profile["rasters"].values()),
+            "bytes_written": sum(raster["bytes_written"] for raster in profile["rasters"].values()),
+        }
+        for profile in profiles.values()
+    ], columns=["script", "country_id", "wall_s", "cpu_s", "read_s", "compute_s", "write_s", "peak_rss_mb",
+                "bytes_read", "bytes_written"])
+    report = report.groupby(["script", "country_id"]).agg(
+        runs=("wall_s", "size"),
+        wall_s=("wall_s", "sum"),
+        cpu_s=("cpu_s", "sum"),
+        read_s=("read_s", "sum"),
+        compute_s=("compute_s", "sum"),
+        write_s=("write_s", "sum"),
+        peak_rss_mb=("peak_rss_mb", "max"),
+        bytes_read=("bytes_read", "sum"),
+        bytes_written=("bytes_written", "sum"),
+    )
+    report["share_of_wall_time"] = report["wall_s"] / report["wall_s"].sum()
+    report.sort_values("wall_s", ascending=False).to_csv(path_to_output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path_to_build", type=str)
+    parser.add_argument("path_to_output", type=str)
+    parser.add_argument("--country_ids", type=str, nargs="*", default=[])
+
+    profile_report(
+        **vars(parser.parse_args())
+    )
@@ -0,0 +1,130 @@
+"""Builds exact cost potential curves of several countries by merging their turbines pre-sorted by cost"""
+
+import argparse
+import heapq
+import itertools
+import sys
+from typing import Iterator, List
+
+import numpy as np
+import pandas as pd
+
+import profiling
+from tables import read_table, MW_PER_TURBINE
+from plot import CURVES, TOLERANCE, downsample, curve_table
+
+CHUNK_SIZE = 1_000_000 # turbines held in memory per stream while merging
+
+
+def sort_turbines(path_to_turbines: str, path_to_engineering_cost: str, path_to_total_cost: str):
+    """Writes the engineering cost and the total cost of all turbines, each in ascending order."""
+    turbines = read_table(path_to_turbines, columns=['lcoe_eur_per_mwh', 'disamenity_cost_eur_per_mwh'])
+    costs = {
+        path_to_engineering_cost: turbines['lcoe_eur_per_mwh'].to_numpy(),
+        path_to_total_cost: (turbines['lcoe_eur_per_mwh'] + turbines['disamenity_cost_eur_per_mwh']).to_numpy()
+    }
+    for path, cost in costs.items():
+        profiling.output(path)
+        np.save(path, np.sort(cost[np.isfinite(cost)]).astype(np.float32))
+
+
+def _stream(path_to_sorted_costs: str, chunk_size: int = CHUNK_SIZE) -> Iterator[float]:
+    costs = np.load(path_to_sorted_costs, mmap_mode="r")
+    for start in range(0, len(costs), chunk_size):
+        yield from np.asarray(costs[start:start + chunk_size]).tolist()
+
+
+def merged_costs(paths_to_sorted_costs: List[str], chunk_size: int = CHUNK_SIZE) -> Iterator[float]:
+    """Yields the costs of all turbines in ascending order, reading at most one chunk per file at a time."""
+    return heapq.merge(*[_stream(path, chunk_size) for path in paths_to_sorted_costs])
+
+
+def merged_curve(paths_to_sorted_costs: List[str], curve: str, tolerance: float = TOLERANCE,
+                 chunk_size: int = CHUNK_SIZE) -> pd.DataFrame:
+    costs = merged_costs(paths_to_sorted_costs, chunk_size)
+    tables = []
+    for start in itertools.count(step=chunk_size):
+        chunk = np.fromiter(itertools.islice(costs, chunk_size), dtype=np.float64)
+        if len(chunk) == 0:
+            break
+        cumulative_capacity = (start + np.arange(len(chunk))) * MW_PER_TURBINE / 1000
+        tables.append(curve_table(*downsample(cumulative_capacity, chunk, tolerance), curve))
+    return pd.concat(tables)
+
+
+def regional_curve(paths_to_engineering_cost: List[str], paths_to_total_cost: List[str], path_to_output: str,
+                   tolerance: float = TOLERANCE):
+    """Writes the cost potential curve of all countries whose sorted costs are given."""
+    paths = {"engineering": paths_to_engineering_cost, "total": paths_to_total_cost}
+    profiling.output(path_to_output)
+    pd.concat([
+        merged_curve(paths[curve], curve, tolerance)
+        for curve in CURVES
+    ]).to_csv(path_to_output, index=False)
+
+
+def _nth_cost(costs: Iterator[float], n: int) -> float:
+    return next(itertools.islice(costs, n, None), np.nan)
+
+
+def marginal_costs(country_ids: List[str], paths_to_engineering_cost: List[str], paths_to_total_cost: List[str],
+                   path_to_targets: str, path_to_output: str):
+    """Reads off the cost of the most expensive turbine needed to meet each country's 2050 capacity target.
+
+    The row "EU" holds the marginal cost of meeting the sum of all targets with the cheapest turbines
+    across all countries. Costs are NaN where the target exceeds the potential.
+    """
+    targets = pd.read_csv(path_to_targets, index_col=0)["0"].reindex(country_ids).dropna()
+    paths = {
+        "engineering": dict(zip(country_ids, paths_to_engineering_cost)),
+        "total": dict(zip(country_ids, paths_to_total_cost))
+    }
+    results = pd.DataFrame(index=list(targets.index) + ["EU"])
+    results.index.name = "country_id"
+    results["target_mw"] = list(targets) + [targets.sum()]
+    for curve in CURVES:
+        results[f"{curve}_cost_eur_per_mwh"] = [
+            _nth_cost(_stream(paths[curve][country_id]), _turbines_needed(target))
+            for country_id, target in targets.items()
+        ] + [
+            _nth_cost(merged_costs([paths[curve][country_id] for country_id in targets.index]),
+                      _turbines_needed(targets.sum()))
+        ]
+    profiling.output(path_to_output)
+    results.to_csv(path_to_output)
+
+
+def _turbines_needed(capacity_mw: float) -> int:
+    return max(int(np.ceil(capacity_mw / MW_PER_TURBINE)) - 1, 0)
+
+
+if __name__ == "__main__" and sys.argv[1:2] == ["sort"]:
+    parser = argparse.ArgumentParser(prog="supply_curve.py sort")
+    parser.add_argument("path_to_turbines", type=str)
+    parser.add_argument("path_to_engineering_cost", type=str)
+    parser.add_argument("path_to_total_cost", type=str)
+
+    sort_turbines(
+        **vars(parser.parse_args(sys.argv[2:]))
+    )
+elif __name__ == "__main__" and sys.argv[1:2] == ["targets"]:
+    parser = argparse.ArgumentParser(prog="supply_curve.py targets")
+    parser.add_argument("path_to_targets", type=str)
+    parser.add_argument("path_to_output", type=str)
+    parser.add_argument("--country_ids", type=str, nargs="+")
+    parser.add_argument("--paths_to_engineering_cost", type=str, nargs="+")
+    parser.add_argument("--paths_to_total_cost", type=str, nargs="+")
+
+    marginal_costs(
+        **vars(parser.parse_args(sys.argv[2:]))
+    )
+elif __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path_to_output", type=str)
+    parser.add_argument("--paths_to_engineering_cost", type=str, nargs="+")
+    parser.add_argument("--paths_to_total_cost", type=str, nargs="+")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+
+    regional_curve(
+        **vars(parser.parse_args())
+    )
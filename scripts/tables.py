@@ -0,0 +1,55 @@
+"""Reads and writes tables either as CSV or as Parquet with compact dtypes"""
+
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+import profiling
+
+PARQUET_SUFFIX = ".parquet"
+COORDINATE_COLUMNS = ["x_m", "y_m"]
+MW_PER_TURBINE = 2 # capacity of each turbine in the turbine tables
+
+
+def is_parquet(path: str) -> bool:
+    return path.endswith(PARQUET_SUFFIX)
+
+
+def compact_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    """Stores coordinates as int32 and all other floating point columns as float32."""
+    df = df.copy()
+    for column in df.columns:
+        if column in COORDINATE_COLUMNS:
+            # EPSG3035's unit is meters, and sub-meter precision is not necessary.
+            df[column] = df[column].astype(np.int32)
+        elif pd.api.types.is_float_dtype(df[column]):
+            df[column] = df[column].astype(np.float32)
+    df.columns = [str(column) for column in df.columns] # Parquet requires string column names
+    return df
+
+
+def write_table(df: pd.DataFrame, path: str, partition_cols: Optional[List[str]] = None):
+    """Writes to Parquet if the path ends with .parquet, and to CSV otherwise.
+
+    Parquet tables can be partitioned, in which case the path is a directory with one subdirectory per
+    partition value.
+    """
+    profiling.output(path)
+    with profiling.phase("write"):
+        if is_parquet(path):
+            compact_dtypes(df).to_parquet(path, index=False, partition_cols=partition_cols)
+        else:
+            assert partition_cols is None, 'CSV tables cannot be partitioned'
+            df.to_csv(path, index=True, header=True)
+
+
+def read_table(path: str, columns: Optional[List[str]] = None, filters: Optional[List[tuple]] = None) -> pd.DataFrame:
+    """Reads tables written by `write_table`, only reading the given columns (and partitions) if given."""
+    with profiling.phase("read"):
+        if is_parquet(path):
+            return pd.read_parquet(path, columns=columns, filters=filters)
+        assert filters is None, 'CSV tables cannot be filtered while reading'
+        if columns is None:
+            return pd.read_csv(path, index_col=0)
+        return pd.read_csv(path, usecols=columns)
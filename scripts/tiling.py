@@ -0,0 +1,151 @@
+"""Processes raster files tile by tile to bound memory use and to parallelise over processes"""
+
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from functools import partial
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+from scipy import signal
+
+import profiling
+from file_management import tif_writer, build_overviews, decode, encode, storage_dtype
+from file_management import RasterEncoding, DEFAULT_ENCODING
+
+
+def tile_windows(height: int, width: int, tile_size: int) -> List[Window]:
+    """Returns windows of at most tile_size x tile_size cells covering the entire raster."""
+    return [
+        Window(col_off=col_off, row_off=row_off,
+               width=min(tile_size, width - col_off), height=min(tile_size, height - row_off))
+        for row_off in range(0, height, tile_size)
+        for col_off in range(0, width, tile_size)
+    ]
+
+
+def _wrapped_ranges(start: int, stop: int, size: int) -> List[Tuple[int, int]]:
+    """Splits [start, stop) into contiguous ranges within [0, size), wrapping around the edges."""
+    assert stop - start <= 2 * size, 'halo must not be larger than the raster'
+    ranges = []
+    while start < stop:
+        wrapped_start = start % size
+        length = min(stop - start, size - wrapped_start)
+        ranges.append((wrapped_start, wrapped_start + length))
+        start += length
+    return ranges
+
+
+def read_wrapped(dataset: rasterio.io.DatasetReader, window: Window, halo: int,
+                 replace_nodata: Optional[float] = None) -> np.ndarray:
+    """Reads the window plus a halo around it; the halo wraps around the edges of the raster."""
+    index, = dataset.indexes
+    row_ranges = _wrapped_ranges(window.row_off - halo, window.row_off + window.height + halo, dataset.height)
+    col_ranges = _wrapped_ranges(window.col_off - halo, window.col_off + window.width + halo, dataset.width)
+    data = np.block([
+        [
+            decode(dataset.read(index, window=Window.from_slices(rows=row_range, cols=col_range)), dataset)
+            for col_range in col_ranges
+        ]
+        for row_range in row_ranges
+    ])
+    if replace_nodata is not None:
+        data = np.where(data == dataset.nodata, replace_nodata, data)
+    return data
+
+
+def _process_tile(function: Callable, source_paths: List[str], window: Window, halo: int,
+                  replace_nodata: Optional[float]) -> Tuple[Window, np.ndarray, float, Dict[str, int]]:
+    # Returns the time spent reading and the bytes read per source path, too, as profiles of worker processes
+    # are lost; they are recorded by the process that writes the tile.
+    tiles = []
+    start = time.perf_counter()
+    for source_path in source_paths:
+        with rasterio.open(source_path) as src:
+            tiles.append(read_wrapped(src, window, halo=halo, replace_nodata=replace_nodata))
+    read_seconds = time.perf_counter() - start
+    return window, function(*tiles), read_seconds, dict(zip(source_paths, [tile.nbytes for tile in tiles]))
+
+
+def _record_read(read_seconds: float, bytes_read: Dict[str, int], worker: bool):
+    profiling.add_phase("read", read_seconds, worker=worker)
+    for source_path, nbytes in bytes_read.items():
+        profiling.bytes_read(source_path, nbytes)
+
+
+def map_tiled(function: Callable, source_paths: List[str], destination_path: str, dtype,
+              tile_size: int, workers: int = 1, halo: int = 0, replace_nodata: Optional[float] = None,
+              encoding: RasterEncoding = DEFAULT_ENCODING):
+    """Applies the function tile by tile and writes the result incrementally.
+
+    The function receives one array per source path, each covering the tile plus the halo, and must
+    return an array covering only the tile. At most twice as many tiles as workers are held in memory.
+    """
+    with rasterio.open(source_paths[0]) as src:
+        height, width = src.height, src.width
+        transform, crs = src.transform, src.crs
+    for source_path in source_paths[1:]:
+        with rasterio.open(source_path) as src:
+            assert (src.height, src.width) == (height, width), 'You are tiling .tif files of different shapes'
+            assert src.transform == transform, 'You are tiling .tif files that have different affine transform matices'
+            assert src.crs == crs, 'You are tiling .tif files that have different crs properties'
+
+    process_tile = partial(_process_tile, function, source_paths, halo=halo, replace_nodata=replace_nodata)
+    windows = tile_windows(height, width, tile_size)
+    with tif_writer(destination_path, height=height, width=width, dtype=storage_dtype(dtype, encoding),
+                    transform=transform, crs=crs, encoding=encoding) as dst:
+        if workers == 1:
+            for window in windows:
+                window, data, *read = process_tile(window)
+                _record_read(*read, worker=False)
+                _write_tile(dst, encode(data.astype(dtype), encoding), window)
+            build_overviews(dst, encoding)
+            return
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            windows = iter(windows)
+            pending = set()
+            while True:
+                for window in windows:
+                    pending.add(executor.submit(process_tile, window))
+                    if len(pending) >= 2 * workers:
+                        break
+                if not pending:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    window, data, *read = future.result()
+                    _record_read(*read, worker=True)
+                    _write_tile(dst, encode(data.astype(dtype), encoding), window)
+        build_overviews(dst, encoding)
+
+
+def _write_tile(dst: rasterio.io.DatasetWriter, data: np.ndarray, window: Window):
+    with profiling.phase("write"):
+        dst.write(data, 1, window=window)
+    profiling.bytes_written(dst.name, data.nbytes)
+
+
+def _convolve_valid(data: np.ndarray, kernel: np.ndarray) -> np.ndarray:
+    return signal.convolve2d(data, kernel, mode='valid')
+
+
+def convolve_tiled(source_path: str, destination_path: str, kernel: np.ndarray, tile_size: int, workers: int = 1,
+                   replace_nodata: Optional[float] = 0, encoding: RasterEncoding = DEFAULT_ENCODING):
+    """Tiled equivalent of `signal.convolve2d(data, kernel, boundary='wrap', mode='same')` for odd kernels."""
+    kernel_rows, kernel_cols = kernel.shape
+    assert kernel_rows == kernel_cols and kernel_rows % 2 == 1, 'Only square kernels of odd size are supported'
+    with rasterio.open(source_path) as src:
+        source_dtype = src.dtypes[0] if src.scales[0] == 1 else np.float64 # scaled integers are read as floats
+        dtype = np.result_type(source_dtype, kernel.dtype)
+    map_tiled(
+        partial(_convolve_valid, kernel=kernel),
+        source_paths=[source_path],
+        destination_path=destination_path,
+        dtype=dtype,
+        tile_size=tile_size,
+        workers=workers,
+        halo=kernel_rows // 2,
+        replace_nodata=replace_nodata,
+        encoding=encoding,
+    )
@@ -0,0 +1,97 @@
+"""Generates hourly generation profiles of all turbines in a country, aggregated by LCOE quantile"""
+
+import argparse
+import sys
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from scipy.spatial import cKDTree
+
+import profiling
+from capacityfactors import site_coordinates
+from tables import read_table, MW_PER_TURBINE
+
+SITES_PER_CHUNK = 16 # all timesteps of this many sites are stored and read together
+
+
+def build_time_series_store(path_to_raw_cf: str, path_to_output: str):
+    """Writes the raw capacity factor time series to a time-contiguous, site-chunked Zarr store.
+
+    In contrast to the annual averages, the time series are kept site-indexed instead of being put on a grid,
+    as the grid would mostly contain NaN. Site coordinates are stored in EPSG:3035.
+    """
+    ts = xr.open_dataset(path_to_raw_cf, chunks={"time": -1, "site_id": SITES_PER_CHUNK})
+    x, y = site_coordinates(ts)
+    profiling.output(path_to_output)
+    (
+        ts["electricity"]
+        .rename(time="timestep", site_id="site")
+        .transpose("site", "timestep")
+        .assign_coords(x=("site", x), y=("site", y))
+        .drop_vars("site")
+        .rename("capacity_factor")
+        .to_dataset()
+        .to_zarr(path_to_output, mode="w", consolidated=True)
+    )
+
+
+def generation_profiles(path_to_time_series: str, path_to_turbines: str, n_bins: int, availability: float,
+                        path_to_output: str):
+    """Aggregates hourly generation (MW) of all turbines by quantile bins of their LCOE.
+
+    Every turbine is attributed to its closest capacity factor site. Sites are read in batches, so that only
+    the time series of a few sites are held in memory at any time.
+    """
+    time_series = xr.open_zarr(path_to_time_series, consolidated=True)
+    turbines = read_table(path_to_turbines, columns=['x_m', 'y_m', 'lcoe_eur_per_mwh'])
+    turbines = turbines.dropna(subset=['lcoe_eur_per_mwh'])
+
+    sites = cKDTree(np.column_stack([time_series.x.values, time_series.y.values]))
+    _, closest_site = sites.query(turbines[['x_m', 'y_m']].values)
+    turbines['site'] = closest_site
+    turbines['lcoe_bin'], bin_edges = pd.qcut(
+        turbines['lcoe_eur_per_mwh'], q=n_bins, labels=False, retbins=True, duplicates='drop'
+    )
+
+    # number of turbines per bin and site; only sites with turbines are read
+    counts = turbines.groupby(['lcoe_bin', 'site']).size().unstack('site', fill_value=0)
+    used_sites = counts.columns.values
+    profiles = np.zeros((len(counts.index), time_series.sizes["timestep"]), dtype=np.float64)
+    for batch in range(0, len(used_sites), SITES_PER_CHUNK):
+        batch_sites = used_sites[batch:batch + SITES_PER_CHUNK]
+        capacity_factors = time_series["capacity_factor"].isel(site=batch_sites).values
+        profiles += counts[batch_sites].values @ np.nan_to_num(capacity_factors)
+    profiles *= MW_PER_TURBINE * availability
+
+    profiling.output(path_to_output)
+    xr.Dataset(
+        {
+            "generation_mw": (("lcoe_bin", "timestep"), profiles),
+            "turbines": ("lcoe_bin", counts.sum(axis="columns").values),
+            "lcoe_from_eur_per_mwh": ("lcoe_bin", bin_edges[counts.index.values]),
+            "lcoe_to_eur_per_mwh": ("lcoe_bin", bin_edges[counts.index.values + 1]),
+        },
+        coords={"lcoe_bin": counts.index.values, "timestep": time_series.timestep.values},
+    ).to_netcdf(path_to_output)
+
+
+if __name__ == "__main__" and sys.argv[1:2] == ["store"]:
+    parser = argparse.ArgumentParser(prog="timeseries.py store")
+    parser.add_argument("path_to_raw_cf", type=str)
+    parser.add_argument("path_to_output", type=str)
+
+    build_time_series_store(
+        **vars(parser.parse_args(sys.argv[2:]))
+    )
+elif __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path_to_time_series", type=str)
+    parser.add_argument("path_to_turbines", type=str)
+    parser.add_argument("n_bins", type=int)
+    parser.add_argument("availability", type=float)
+    parser.add_argument("path_to_output", type=str)
+
+    generation_profiles(
+        **vars(parser.parse_args())
+    )
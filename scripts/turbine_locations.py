@@ -1,71 +1,137 @@
 """Uses the GLAES package and a set of exclusion criteria to generate a list of potential wind turbine locations"""
 
 import argparse
+import hashlib
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import List, Optional, Tuple
 
 import geokit as gk
 import glaes as gl
 import pandas as pd
 import numpy as np
+from osgeo import gdal, ogr
+from scipy.spatial import cKDTree
 
+from tables import write_table
 
-def turbine_placement(input_path: str, prior_directory_path: str, turbine_separation_m: int,
-                      output_path_csv: str, output_path_tif: str):
-    assert turbine_separation_m > 50 # value is in meters and must not be smaller than 50
-
-    gl.Priors.loadDirectory(prior_directory_path)
-
-    ec = gl.ExclusionCalculator(input_path, srs=3035, pixelSize=100, limitOne=False)
+PIXEL_SIZE_M = 100
+_priors_stamp = "" # stamp of the loaded priors, part of all exclusion cache keys
 
+EXCLUSIONS = [
     # EXCLUSIONS BASED ON THRESHOLDS
 
     # areas above the alpine forest line
-    ec.excludePrior("elevation_threshold", value=(1800, None))  # alpine forest line assumed at 1750 m
+    ("elevation_threshold", (1800, None)),  # alpine forest line assumed at 1750 m
 
     # maximum slope (degrees) and sea
-    ec.excludePrior("slope_threshold", value=(10, None))
+    ("slope_threshold", (10, None)),
 
     # EXCLUSIONS BASED ON PROXIMITY
 
     # lakes (> 50 ha)
-    ec.excludePrior("lake_proximity", value=(None, 400))
+    ("lake_proximity", (None, 400)),
 
     # other water bodies
-    ec.excludePrior("river_proximity", value=(None, 200))
+    ("river_proximity", (None, 200)),
 
     # settlement areas
-    ec.excludePrior("settlement_proximity", value=(None, 200))
+    ("settlement_proximity", (None, 200)),
 
     # industrial, commercial, and mining areas
-    ec.excludePrior("industrial_proximity", value=(None, 300))
-    ec.excludePrior("mining_proximity", value=(None, 100))
+    ("industrial_proximity", (None, 300)),
+    ("mining_proximity", (None, 100)),
 
     # railways, motorways, primary and secondary roads
-    ec.excludePrior("railway_proximity", value=(None, 150))
-    ec.excludePrior("roads_main_proximity", value=(None, 200))
-    ec.excludePrior("roads_secondary_proximity", value=(None, 100))
+    ("railway_proximity", (None, 150)),
+    ("roads_main_proximity", (None, 200)),
+    ("roads_secondary_proximity", (None, 100)),
 
     # airport public safety zones
-    ec.excludePrior("airport_proximity", value=(None, 5000))
+    ("airport_proximity", (None, 5000)),
 
     # power grid (>110kV)
-    ec.excludePrior("power_line_proximity", value=(None, 200))
+    ("power_line_proximity", (None, 200)),
 
     # national parks
-    ec.excludePrior("protected_park_proximity", value=(None, 1000))
+    ("protected_park_proximity", (None, 1000)),
 
     # Natura 2000 - protected habitats and birds
-    ec.excludePrior("protected_habitat_proximity", value=(None, 1500))
-    ec.excludePrior("protected_bird_proximity", value=(None, 1500))
+    ("protected_habitat_proximity", (None, 1500)),
+    ("protected_bird_proximity", (None, 1500)),
 
-    ec.excludePrior("protected_reserve_proximity", value=(None, 500))
+    ("protected_reserve_proximity", (None, 500)),
 
     # other protected areas (biosphere reserves, landscape protection areas, natural monuments)
-    ec.excludePrior("protected_biosphere_proximity", value=(None, 300))
-    ec.excludePrior("protected_landscape_proximity", value=(None, 500))
-    ec.excludePrior("protected_natural_monument_proximity", value=(None, 1000))
+    ("protected_biosphere_proximity", (None, 300)),
+    ("protected_landscape_proximity", (None, 500)),
+    ("protected_natural_monument_proximity", (None, 1000)),
+
+    ("protected_wilderness_proximity", (None, 1000)),
+]
+
+
+def turbine_placement(input_path: str, prior_directory_path: str, turbine_separation_m: int,
+                      output_path_table: str, output_path_tif: str, exclusion_cache: Optional[str] = None):
+    assert turbine_separation_m > 50 # value is in meters and must not be smaller than 50
+
+    _load_priors(prior_directory_path)
+    _place_turbines(input_path, turbine_separation_m, output_path_table, output_path_tif, exclusion_cache)
+
+
+def turbine_placement_batch(country_ids: List[str], input_path: str, prior_directory_path: str,
+                            turbine_separation_m: int, output_path_table: str, output_path_tif: str,
+                            workers: int, exclusion_cache: Optional[str] = None, tile_size_m: int = 0):
+    """Places turbines in all countries using worker processes that load GLAES and its priors only once.
+
+    The input and output paths contain the placeholder `{country_id}`. Countries are processed from a queue;
+    results are the same as from `turbine_placement` per country. With a positive tile_size_m, countries are
+    instead processed one after the other, with their tiles in parallel, as in `turbine_placement_tiled`.
+    """
+    assert turbine_separation_m > 50 # value is in meters and must not be smaller than 50
 
-    ec.excludePrior("protected_wilderness_proximity", value=(None, 1000))
-    
+    with _warm_pool(prior_directory_path, workers) as executor:
+        if tile_size_m > 0:
+            for country_id in country_ids:
+                _place_turbines_tiled(
+                    executor,
+                    input_path.format(country_id=country_id),
+                    turbine_separation_m,
+                    output_path_table.format(country_id=country_id),
+                    output_path_tif.format(country_id=country_id),
+                    tile_size_m,
+                    exclusion_cache,
+                )
+                print(f"Placed turbines in {country_id}.")
+            return
+        futures = [
+            executor.submit(
+                _place_turbines,
+                input_path.format(country_id=country_id),
+                turbine_separation_m,
+                output_path_table.format(country_id=country_id),
+                output_path_tif.format(country_id=country_id),
+                exclusion_cache,
+            )
+            for country_id in country_ids
+        ]
+        for country_id, future in zip(country_ids, futures):
+            future.result()
+            print(f"Placed turbines in {country_id}.")
+
+
+def _place_turbines(input_path: str, turbine_separation_m: int, output_path_table: str, output_path_tif: str,
+                    exclusion_cache: Optional[str]):
+    # requires priors to be loaded
+    ec = gl.ExclusionCalculator(input_path, srs=3035, pixelSize=PIXEL_SIZE_M, limitOne=False)
+
+    if exclusion_cache is None:
+        for prior, value in EXCLUSIONS:
+            ec.excludePrior(prior, value=value)
+    else:
+        exclude_cached(ec, _shape_hash(input_path), exclusion_cache)
 
     #turbine placement
     ec.distributeItems(separation=turbine_separation_m)
@@ -81,12 +147,195 @@ def turbine_placement(input_path: str, prior_directory_path: str, turbine_separa
         # EPSG3035's unit is meters, and sub-meter precision is not necessary.
         turbine_coordinates = turbine_coordinates.astype(int)
     # Save turbine placement
-    (
+    write_table(
         pd
         .DataFrame(turbine_coordinates)
-        .rename(columns={0: "x_m", 1: "y_m"})
-        .to_csv(output_path_csv, index=True, header=True)
+        .rename(columns={0: "x_m", 1: "y_m"}),
+        output_path_table
+    )
+
+
+def exclude_cached(ec: gl.ExclusionCalculator, shape_hash: str, exclusion_cache: str):
+    """Applies all exclusions, reusing the mask of each prior and threshold from the cache if possible.
+
+    As exclusions only ever set cells to unavailable, the result is the same as applying all exclusions one
+    after the other. Only masks of new or changed exclusions are calculated.
+    """
+    initial_availability = _binary_availability(ec).copy()
+    excluded = np.zeros(initial_availability.shape, dtype=bool)
+    for prior, value in EXCLUSIONS:
+        path_to_mask = os.path.join(exclusion_cache, _exclusion_cache_key(shape_hash, prior, value) + ".npz")
+        if os.path.isfile(path_to_mask):
+            mask = _read_mask(path_to_mask)
+        else:
+            ec._availability = initial_availability.copy()
+            ec.excludePrior(prior, value=value)
+            mask = (_binary_availability(ec) == 0) & (initial_availability > 0)
+            _write_mask(mask, path_to_mask)
+        excluded |= mask
+    ec._availability = np.where(excluded, 0, initial_availability).astype(initial_availability.dtype)
+
+
+def _binary_availability(ec: gl.ExclusionCalculator) -> np.ndarray:
+    # GLAES has no public way to set the availability, so the cache combines masks on the private matrix. This
+    # requires cells to be either fully available or fully excluded, which holds for the prior exclusions
+    # here; fail instead of caching wrong masks should a GLAES version exclude cells partially.
+    availability = ec._availability
+    assert np.isin(availability, (0, availability.max())).all(), 'exclusion cache requires binary availability'
+    return availability
+
+
+def _shape_hash(input_path: str) -> str:
+    # hashes the geometries and the spatial reference only, as other contents of the files, e.g. the date of the
+    # last update in the header of a .dbf, change when an identical shape is written again
+    dataset = ogr.Open(input_path)
+    layer = dataset.GetLayer()
+    sha = hashlib.sha256(layer.GetSpatialRef().ExportToWkt().encode())
+    for feature in layer:
+        sha.update(feature.GetGeometryRef().ExportToWkb())
+    return sha.hexdigest()
+
+
+def _exclusion_cache_key(shape_hash: str, prior: str, value: tuple) -> str:
+    assert _priors_stamp, 'priors must be loaded before their exclusions are cached'
+    key = f"{shape_hash}-{PIXEL_SIZE_M}-{prior}-{value}-{_priors_stamp}"
+    return f"{prior}-{hashlib.sha256(key.encode()).hexdigest()[:16]}"
+
+
+def _read_mask(path_to_mask: str) -> np.ndarray:
+    with np.load(path_to_mask) as stored:
+        shape = tuple(stored["shape"])
+        return np.unpackbits(stored["bits"], count=int(np.prod(shape))).reshape(shape).astype(bool)
+
+
+def _write_mask(mask: np.ndarray, path_to_mask: str):
+    os.makedirs(os.path.dirname(path_to_mask), exist_ok=True)
+    # write to a temporary file first, as several jobs may populate the cache at the same time
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path_to_mask), suffix=".npz", delete=False) as f:
+        np.savez(f, bits=np.packbits(mask, axis=None), shape=np.array(mask.shape))
+    os.replace(f.name, path_to_mask)
+
+
+def turbine_placement_tiled(input_path: str, prior_directory_path: str, turbine_separation_m: int,
+                            output_path_table: str, output_path_tif: str, tile_size_m: int, workers: int,
+                            exclusion_cache: Optional[str] = None):
+    """Places turbines tile by tile in a process pool.
+
+    Each tile is extended by the turbine separation on all sides. Only turbines within the tile itself are
+    kept, and turbines that violate the separation across tile seams are removed deterministically.
+    """
+    assert turbine_separation_m > 50 # value is in meters and must not be smaller than 50
+
+    with _warm_pool(prior_directory_path, workers) as executor:
+        _place_turbines_tiled(executor, input_path, turbine_separation_m, output_path_table, output_path_tif,
+                              tile_size_m, exclusion_cache)
+
+
+def _place_turbines_tiled(executor: ProcessPoolExecutor, input_path: str, turbine_separation_m: int,
+                          output_path_table: str, output_path_tif: str, tile_size_m: int,
+                          exclusion_cache: Optional[str]):
+    tiles = _tiles(input_path, tile_size_m=tile_size_m, overlap_m=turbine_separation_m)
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_path_tif))) as tmpdir:
+        paths_to_tile_tifs = [os.path.join(tmpdir, f"tile-{i}.tif") for i in range(len(tiles))]
+        turbine_coordinates = list(executor.map(
+            partial(_place_in_tile, turbine_separation_m=turbine_separation_m, exclusion_cache=exclusion_cache),
+            tiles,
+            paths_to_tile_tifs,
+        ))
+        # map of available area (currently not used)
+        gdal.Warp(output_path_tif, paths_to_tile_tifs, options=gdal.WarpOptions(creationOptions=["COMPRESS=LZW"]))
+
+    turbine_coordinates = _remove_seam_conflicts(turbine_coordinates, turbine_separation_m)
+    # EPSG3035's unit is meters, and sub-meter precision is not necessary.
+    write_table(
+        pd
+        .DataFrame(turbine_coordinates.astype(int))
+        .rename(columns={0: "x_m", 1: "y_m"}),
+        output_path_table
+    )
+
+
+def _warm_pool(prior_directory_path: str, workers: int) -> ProcessPoolExecutor:
+    # worker processes import GLAES and load all priors once, when they start
+    return ProcessPoolExecutor(max_workers=workers, initializer=_load_priors, initargs=(prior_directory_path, ))
+
+
+def _load_priors(prior_directory_path: str):
+    global _priors_stamp
+    gl.Priors.loadDirectory(prior_directory_path)
+    _priors_stamp = _directory_stamp(prior_directory_path)
+
+
+def _directory_stamp(directory_path: str) -> str:
+    # hashes name, modification time, and size of all files, so that cached masks of replaced priors are not used
+    sha = hashlib.sha256()
+    for root, _, filenames in sorted(os.walk(directory_path)):
+        for filename in sorted(filenames):
+            path = os.path.join(root, filename)
+            stat = os.stat(path)
+            sha.update(f"{os.path.relpath(path, directory_path)}-{stat.st_mtime_ns}-{stat.st_size}".encode())
+    return sha.hexdigest()
+
+
+def _tiles(input_path: str, tile_size_m: int, overlap_m: int) -> List[Tuple[str, Tuple[float, float, float, float]]]:
+    # Returns the country shape within each extended tile (as WKT in EPSG:3035) and the bounds of the tile.
+    country = gk.geom.transform(
+        gk.vector.extractFeatures(input_path).geom.tolist(),
+        toSRS=gk.srs.EPSG3035
     )
+    shape = country[0].Clone()
+    for geom in country[1:]:
+        shape = shape.Union(geom)
+    x_min, x_max, y_min, y_max = shape.GetEnvelope()
+    tiles = []
+    for tile_x in np.arange(x_min, x_max, tile_size_m):
+        for tile_y in np.arange(y_min, y_max, tile_size_m):
+            bounds = (tile_x, tile_y, tile_x + tile_size_m, tile_y + tile_size_m)
+            extended_box = gk.geom.box(
+                bounds[0] - overlap_m, bounds[1] - overlap_m, bounds[2] + overlap_m, bounds[3] + overlap_m,
+                srs=gk.srs.EPSG3035
+            )
+            tile_shape = shape.Intersection(extended_box)
+            if tile_shape is not None and not tile_shape.IsEmpty() and tile_shape.GetArea() > PIXEL_SIZE_M ** 2:
+                tiles.append((tile_shape.ExportToWkt(), bounds))
+    return tiles
+
+
+def _place_in_tile(tile: Tuple[str, Tuple[float, float, float, float]], path_to_tif: str, turbine_separation_m: int,
+                   exclusion_cache: Optional[str]) -> np.ndarray:
+    wkt, (x_min, y_min, x_max, y_max) = tile
+    ec = gl.ExclusionCalculator(
+        gk.geom.convertWKT(wkt, srs=gk.srs.EPSG3035), srs=3035, pixelSize=PIXEL_SIZE_M, limitOne=False
+    )
+    if exclusion_cache is None:
+        for prior, value in EXCLUSIONS:
+            ec.excludePrior(prior, value=value)
+    else:
+        exclude_cached(ec, hashlib.sha256(wkt.encode()).hexdigest(), exclusion_cache)
+    ec.distributeItems(separation=turbine_separation_m)
+    ec.save(path_to_tif, overwrite=True)
+
+    coordinates = np.asarray(ec.itemCoords, dtype=np.float64).reshape(-1, 2)
+    within_x = (coordinates[:, 0] >= x_min) & (coordinates[:, 0] < x_max)
+    within_y = (coordinates[:, 1] >= y_min) & (coordinates[:, 1] < y_max)
+    return coordinates[within_x & within_y]
+
+
+def _remove_seam_conflicts(coordinates_by_tile: List[np.ndarray], turbine_separation_m: int) -> np.ndarray:
+    # Greedily keeps turbines in order of tiles, removing later turbines closer than the separation to kept ones.
+    coordinates = np.concatenate(coordinates_by_tile)
+    if len(coordinates) == 0:
+        return coordinates
+    pairs = cKDTree(coordinates).query_pairs(r=np.nextafter(turbine_separation_m, 0), output_type="ndarray")
+    neighbours = {}
+    for i, j in np.sort(pairs, axis=1):
+        neighbours.setdefault(j, []).append(i)
+    keep = np.ones(len(coordinates), dtype=bool)
+    for j in sorted(neighbours):
+        if keep[neighbours[j]].any():
+            keep[j] = False
+    return coordinates[keep]
 
 
 if __name__ == "__main__":
@@ -94,9 +343,26 @@ if __name__ == "__main__":
     parser.add_argument("input_path", type=str)
     parser.add_argument("prior_directory_path", type=str)
     parser.add_argument("turbine_separation_m", type=int)
-    parser.add_argument("output_path_csv", type=str)
+    parser.add_argument("output_path_table", type=str)
     parser.add_argument("output_path_tif", type=str)
+    parser.add_argument("--exclusion_cache", type=str, default=None)
+    parser.add_argument("--tile_size_m", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--country_ids", type=str, nargs="*")
+    args = vars(parser.parse_args())
+    country_ids = args.pop("country_ids")
+    tile_size_m = args.pop("tile_size_m")
+    workers = args.pop("workers")
 
-    turbine_placement(
-        **vars(parser.parse_args())
-    )
+    if country_ids: # all countries in warm worker processes
+        turbine_placement_batch(
+            country_ids=country_ids, workers=workers, tile_size_m=tile_size_m, **args
+        )
+    elif tile_size_m > 0:
+        turbine_placement_tiled(
+            tile_size_m=tile_size_m, workers=workers, **args
+        )
+    else:
+        turbine_placement(
+            **args
+        )
@@ -0,0 +1,157 @@
+"""Stores all turbines in a packed grid index to build cost potential curves of arbitrary polygons"""
+
+import argparse
+import sys
+from typing import List
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely.geometry import box
+from shapely.geometry.base import BaseGeometry
+from shapely.prepared import prep
+try:
+    from shapely import contains_xy
+except ImportError: # Shapely < 2
+    from shapely.vectorized import contains as contains_xy
+
+import profiling
+from tables import read_table
+from plot import CURVES, TOLERANCE, downsample, curve_table, sorted_curve
+
+CELL_SIZE_M = 10000 # edge length of the cells of the grid index
+EPSG3035 = "EPSG:3035"
+COLUMNS = ['x_m', 'y_m', 'lcoe_eur_per_mwh', 'disamenity_cost_eur_per_mwh']
+
+
+def build_turbine_store(paths_to_turbines: List[str], country_ids: List[str], path_to_output: str,
+                        cell_size_m: int = CELL_SIZE_M):
+    """Sorts the turbines of all countries by grid cell and stores them with the offsets of each cell."""
+    turbines = pd.concat(
+        [read_table(path, columns=COLUMNS) for path in paths_to_turbines],
+        keys=range(len(country_ids)),
+        names=['country', None]
+    ).reset_index(level='country')
+    x_min = np.floor(turbines['x_m'].min() / cell_size_m) * cell_size_m
+    y_min = np.floor(turbines['y_m'].min() / cell_size_m) * cell_size_m
+    n_cols = int((turbines['x_m'].max() - x_min) // cell_size_m) + 1
+
+    cols = ((turbines['x_m'].to_numpy() - x_min) // cell_size_m).astype(np.int64)
+    rows = ((turbines['y_m'].to_numpy() - y_min) // cell_size_m).astype(np.int64)
+    cell_ids = rows * n_cols + cols
+    order = np.argsort(cell_ids, kind="stable")
+    cells, offsets = np.unique(cell_ids[order], return_index=True)
+
+    profiling.output(path_to_output)
+    np.savez(
+        path_to_output,
+        x_m=turbines['x_m'].to_numpy()[order],
+        y_m=turbines['y_m'].to_numpy()[order],
+        lcoe_eur_per_mwh=turbines['lcoe_eur_per_mwh'].to_numpy(dtype=np.float32)[order],
+        disamenity_cost_eur_per_mwh=turbines['disamenity_cost_eur_per_mwh'].to_numpy(dtype=np.float32)[order],
+        country=turbines['country'].to_numpy(dtype=np.int16)[order],
+        country_ids=np.array(country_ids),
+        cells=cells,
+        offsets=np.append(offsets, len(order)),
+        grid=np.array([x_min, y_min, cell_size_m, n_cols], dtype=np.float64),
+    )
+
+
+class TurbineStore:
+    """Finds turbines within polygons, testing points only in cells on the boundary of a polygon.
+
+    Polygons must be in EPSG:3035.
+    """
+
+    def __init__(self, path_to_store: str):
+        with np.load(path_to_store) as store:
+            self._data = {name: store[name] for name in store.files}
+        self.x_min, self.y_min, self.cell_size_m, n_cols = self._data.pop("grid")
+        self.n_cols = int(n_cols)
+        self.country_ids = self._data.pop("country_ids")
+        self._cells = self._data.pop("cells")
+        self._offsets = self._data.pop("offsets")
+
+    def indices(self, polygon: BaseGeometry) -> np.ndarray:
+        """Returns the indices of all turbines within the polygon."""
+        prepared = prep(polygon)
+        x_min, y_min, x_max, y_max = polygon.bounds
+        col_min, col_max = [int((x - self.x_min) // self.cell_size_m) for x in (x_min, x_max)]
+        row_min, row_max = [int((y - self.y_min) // self.cell_size_m) for y in (y_min, y_max)]
+        col_min, col_max = max(col_min, 0), min(col_max, self.n_cols - 1)
+
+        indices = []
+        for row in range(max(row_min, 0), row_max + 1):
+            row_cells = row * self.n_cols + np.arange(col_min, col_max + 1)
+            positions = np.minimum(np.searchsorted(self._cells, row_cells), len(self._cells) - 1)
+            found = self._cells[positions] == row_cells
+            for cell, position in zip(row_cells[found], positions[found]):
+                start, stop = self._offsets[position], self._offsets[position + 1]
+                col = cell - row * self.n_cols
+                cell_box = box(
+                    self.x_min + col * self.cell_size_m, self.y_min + row * self.cell_size_m,
+                    self.x_min + (col + 1) * self.cell_size_m, self.y_min + (row + 1) * self.cell_size_m
+                )
+                if prepared.contains(cell_box):
+                    indices.append(np.arange(start, stop))
+                elif prepared.intersects(cell_box):
+                    inside = contains_xy(
+                        polygon, self._data["x_m"][start:stop], self._data["y_m"][start:stop]
+                    )
+                    indices.append(start + np.flatnonzero(inside))
+        return np.concatenate(indices) if indices else np.array([], dtype=np.int64)
+
+    def turbines(self, polygon: BaseGeometry) -> pd.DataFrame:
+        """Returns location, costs, and country of all turbines within the polygon."""
+        indices = self.indices(polygon)
+        turbines = pd.DataFrame({name: values[indices] for name, values in self._data.items()})
+        turbines['country'] = self.country_ids[turbines['country']]
+        return turbines.rename(columns={'country': 'country_id'})
+
+    def curve(self, polygon: BaseGeometry, tolerance: float = TOLERANCE) -> pd.DataFrame:
+        """Returns the downsampled cost potential curve of all turbines within the polygon."""
+        indices = self.indices(polygon)
+        lcoe = self._data['lcoe_eur_per_mwh'][indices].astype(np.float64)
+        costs = {
+            "engineering": lcoe,
+            "total": lcoe + self._data['disamenity_cost_eur_per_mwh'][indices]
+        }
+        return pd.concat([
+            curve_table(*downsample(*sorted_curve(costs[curve]), tolerance), curve)
+            for curve in CURVES
+        ])
+
+
+def query_turbine_store(path_to_store: str, path_to_polygons: str, name_column: str, path_to_output: str,
+                        tolerance: float = TOLERANCE):
+    """Writes the cost potential curves of all polygons in a file, identified by the name column."""
+    store = TurbineStore(path_to_store)
+    polygons = gpd.read_file(path_to_polygons).to_crs(EPSG3035)
+    profiling.output(path_to_output)
+    pd.concat([
+        store.curve(polygon, tolerance).assign(region=name)
+        for name, polygon in zip(polygons[name_column], polygons.geometry)
+    ]).to_csv(path_to_output, index=False)
+
+
+if __name__ == "__main__" and sys.argv[1:2] == ["query"]:
+    parser = argparse.ArgumentParser(prog="turbine_store.py query")
+    parser.add_argument("path_to_store", type=str)
+    parser.add_argument("path_to_polygons", type=str)
+    parser.add_argument("name_column", type=str)
+    parser.add_argument("path_to_output", type=str)
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+
+    query_turbine_store(
+        **vars(parser.parse_args(sys.argv[2:]))
+    )
+elif __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths_to_turbines", type=str, nargs="+")
+    parser.add_argument("path_to_output", type=str)
+    parser.add_argument("--country_ids", type=str, nargs="+")
+    parser.add_argument("--cell_size_m", type=int, default=CELL_SIZE_M)
+
+    build_turbine_store(
+        **vars(parser.parse_args())
+    )